@@ -1,10 +1,19 @@
-from fastapi import FastAPI, WebSocket
+from collections import defaultdict
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 import tasks
+from finance.core import broker, checkpoint, metrics, progress, sessions
 from celery.result import AsyncResult
 import asyncio
 
 app = FastAPI()
 
+# events buffered per websocket client
+QUEUE_SIZE = 100
+# how often a task without progress events is checked for its result
+STATE_CHECK_SECONDS = 15
+
 
 @app.get("/load_all_tickers")
 async def load_all_tickers(database_name="finance"):
@@ -13,43 +22,172 @@ async def load_all_tickers(database_name="finance"):
 
 
 @app.get("/load_instrument_details")
-async def load_instrument_details(database_name="finance"):
-    result = tasks.load_instrument_details.delay(database_name)
+async def load_instrument_details(database_name="finance", run_id: str = None):
+    result = tasks.load_instrument_details.delay(database_name, run_id=run_id)
     return {"task_id": result.id}
 
 
 @app.get("/load_quotes")
-async def load_quotes(database_name="finance", period="1d", symbol_prefix: str = None):
-    result = tasks.load_quotes.delay(database_name, period=period, symbol_prefix=symbol_prefix)
+async def load_quotes(
+    database_name="finance", period="1d", symbol_prefix: str = None, chunk_size: int = 100, run_id: str = None
+):
+    result = tasks.load_quotes.delay(
+        database_name, period=period, symbol_prefix=symbol_prefix, chunk_size=chunk_size, run_id=run_id
+    )
+    return {"task_id": result.id}
+
+
+@app.get("/load_quotes_tier")
+async def load_quotes_tier(tier: str, database_name="finance", period="incremental"):
+    result = tasks.load_quotes_tier.delay(tier, database_name, period=period)
+    return {"task_id": result.id}
+
+
+@app.get("/load_intraday")
+async def load_intraday(database_name="finance", interval="5m", symbol_prefix: str = None, chunk_size: int = 100):
+    result = tasks.load_intraday.delay(
+        database_name, interval=interval, symbol_prefix=symbol_prefix, chunk_size=chunk_size
+    )
     return {"task_id": result.id}
 
 
 @app.get("/load_options_and_quotes")
-async def load_options_and_quotes(database_name="finance"):
-    result = tasks.load_options_and_quotes.delay(database_name)
+async def load_options_and_quotes(database_name="finance", period: str = None, run_id: str = None):
+    result = tasks.load_options_and_quotes.delay(database_name, period=period, run_id=run_id)
     return {"task_id": result.id}
 
 
-@app.websocket("/ws/task/{task_id}")
-async def websocket_endpoint(websocket: WebSocket, task_id: str):
-    await websocket.accept()
+@app.get("/load_option_analytics")
+async def load_option_analytics(database_name="finance", symbol_prefix: str = None):
+    result = tasks.load_option_analytics.delay(database_name, symbol_prefix=symbol_prefix)
+    return {"task_id": result.id}
+
+
+@app.get("/export_parquet")
+async def export_parquet(database_name="finance", root: str = None):
+    result = tasks.export_parquet.delay(database_name, **({"root": root} if root else {}))
+    return {"task_id": result.id}
+
+
+@app.get("/http_cache_stats")
+async def http_cache_stats():
+    # every worker publishes its own counters, a task would only report the worker that ran it
+    return await run_in_threadpool(sessions.collect_stats, broker.get_redis())
+
+
+@app.get("/checkpoints")
+async def list_checkpoints():
+    return await run_in_threadpool(checkpoint.list_checkpoints, broker.get_redis())
+
 
-    # Get the task result asynchronously
-    result = AsyncResult(task_id, app=tasks.celery_app)
+@app.get("/checkpoints/{run_id}")
+async def get_checkpoint(run_id: str):
+    return await run_in_threadpool(checkpoint.get_checkpoint, broker.get_redis(), run_id)
 
-    while True:
-        if result.ready():
-            break
-        await websocket.send_text(result.state)
-        await asyncio.sleep(1)
 
-    # Task is ready, send the final result
-    if result.successful():
-        await websocket.send_text(str(result.state))
-        await websocket.send_text(str(result.result))
+@app.delete("/checkpoints/{run_id}")
+async def clear_checkpoint(run_id: str):
+    await run_in_threadpool(checkpoint.clear_checkpoint, broker.get_redis(), run_id)
+    return {"run_id": run_id, "cleared": True}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def export_metrics():
+    snapshot = await run_in_threadpool(metrics.collect, broker.get_redis())
+    return metrics.render(snapshot)
+
+
+class ProgressHub:
+    """One redis subscription per task, fanned out to every websocket watching it."""
+
+    def __init__(self) -> None:
+        self.queues = defaultdict(set)
+        self.readers = {}
+
+    def subscribe(self, task_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.queues[task_id].add(queue)
+        if task_id not in self.readers:
+            self.readers[task_id] = asyncio.create_task(self._read(task_id))
+        return queue
+
+    def unsubscribe(self, task_id: str, queue: asyncio.Queue):
+        self.queues[task_id].discard(queue)
+        if not self.queues[task_id]:
+            del self.queues[task_id]
+            reader = self.readers.pop(task_id, None)
+            if reader:
+                reader.cancel()
+
+    async def _read(self, task_id: str):
+        client = broker.get_async_redis()
+        if client is None:
+            return
+        pubsub = client.pubsub()
+        await pubsub.subscribe(progress.channel(task_id))
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    self.publish(task_id, progress.decode(message["data"]))
+        finally:
+            await pubsub.unsubscribe(progress.channel(task_id))
+            await pubsub.close()
+
+    def publish(self, task_id: str, event: dict):
+        for queue in self.queues.get(task_id, ()):
+            if queue.full():
+                # a slow client only misses intermediate events, the latest one always gets through
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+
+hub = ProgressHub()
+
+
+def final_result(task_id: str) -> AsyncResult:
+    """The result that ends a run, following fanned out tasks to their summary task; None while running.
+
+    Queries the result backend, call it from the threadpool.
+    """
+    result = AsyncResult(task_id, app=tasks.App)
+    if not result.ready():
+        return None
+    if result.successful() and isinstance(result.result, dict) and "summary_task_id" in result.result:
+        return final_result(result.result["summary_task_id"])
+    return result
+
+
+@app.websocket("/ws/task/{task_id}")
+async def websocket_endpoint(websocket: WebSocket, task_id: str):
+    await websocket.accept()
+    queue = hub.subscribe(task_id)
+    try:
+        client = broker.get_async_redis()
+        event = progress.decode(await client.get(progress.last_event_key(task_id))) if client else None
+        while not (event and event["finished"]):
+            if event:
+                await websocket.send_json(event)
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=STATE_CHECK_SECONDS)
+            except asyncio.TimeoutError:
+                # tasks that do not publish progress end when their result is ready
+                event = None
+                if await run_in_threadpool(final_result, task_id) is not None:
+                    break
+        if event:
+            await websocket.send_json(event)
+
+        # Task is ready, send the final result
+        result = await run_in_threadpool(final_result, task_id)
+        if result is not None:
+            await websocket.send_text(str(result.state))
+            if result.successful():
+                await websocket.send_text(str(result.result))
         await websocket.close()
-    else:
-        await websocket.send_text(result.state)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        hub.unsubscribe(task_id, queue)
 
 
 if __name__ == "__main__":
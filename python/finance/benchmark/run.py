@@ -0,0 +1,203 @@
+"""Offline ETL benchmark.
+
+Record the upstream responses once:
+
+    python -m finance.benchmark.run --record --sizes 50
+
+then replay them as often as needed without network access:
+
+    python -m finance.benchmark.run --sizes 10,50 --output bench.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import threading
+import time
+
+import requests_cache
+
+from finance.core import get_tickers as gt
+from finance.core import sessions
+from finance.instrument import all_tickers_load, load_instrument
+from finance.quotes import load_historical_quotes
+
+# Set up the logger
+import logging
+
+logger = logging.getLogger()
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), "fixtures", "upstream")
+STAGES = ["tickers", "quotes", "fundamentals", "options"]
+RSS_SAMPLE_SECONDS = 0.05
+
+
+def fixture_session(path: str = FIXTURES_PATH, record: bool = False) -> requests_cache.CachedSession:
+    """Session that stores every upstream response in `path`, or only serves what was stored there."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    session = requests_cache.CachedSession(
+        path,
+        backend="sqlite",
+        expire_after=requests_cache.NEVER_EXPIRE,
+        allowable_methods=("GET", "POST"),
+        # yahoo signs requests with a crumb that changes per session
+        ignored_parameters=["crumb"],
+    )
+    session.headers["User-agent"] = sessions.USER_AGENT
+    if not record:
+        # a response that was never recorded comes back as a 504 instead of going upstream
+        session.settings.only_if_cached = True
+    return session
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux, and the peak of the whole process so far
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rss_mb() -> float:
+    """Return the current resident set size, None where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class RssSampler:
+    """Sample the resident set size from a background thread while the block runs.
+
+    ru_maxrss only holds the peak of the process, so every stage after the largest one would
+    report that stage's peak. Falls back to it where /proc is not available.
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLE_SECONDS) -> None:
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def __enter__(self):
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = rss_mb()
+        if rss is not None:
+            self.peak = max(self.peak or 0.0, rss)
+
+    def peak_mb(self) -> float:
+        return self.peak if self.peak is not None else peak_rss_mb()
+
+
+def run_stage(name: str, loader, work) -> dict:
+    started = time.perf_counter()
+    with RssSampler() as rss, loader.buffered() as write_buffer:
+        work()
+    seconds = time.perf_counter() - started
+    rows = write_buffer.stats().get("rows", 0)
+    result = {
+        "stage": name,
+        "seconds": round(seconds, 3),
+        "rows": rows,
+        "rows_per_sec": round(rows / seconds, 1) if seconds else 0.0,
+        "peak_rss_mb": round(rss.peak_mb(), 1),
+    }
+    logger.info(result)
+    return result
+
+
+def run(database_name: str, size: int, period: str, stages: list[str], user: str, password: str) -> list[dict]:
+    """Run the selected stages against `database_name` for the `size` largest symbols.
+
+    The database is truncated first, rows left by an earlier run would be skipped as unchanged.
+    """
+    loader = all_tickers_load.Tickers(database_name)
+    loader.login(user, password)
+    loader.connection.execute(f"TRUNCATE DATABASE {database_name};")
+    results = []
+
+    if "tickers" in stages:
+        # the screener snapshot of an earlier run would spare the tickers stage its download
+        gt.clear_snapshot()
+        results.append(run_stage("tickers", loader, loader.load))
+    symbols = gt.get_biggest_n_tickers(size)
+
+    if "quotes" in stages:
+        loader = load_historical_quotes.Quotes(database_name)
+        loader.login(user, password)
+        results.append(run_stage("quotes", loader, lambda: loader.load_batch(symbols, period=period)))
+
+    if "fundamentals" in stages or "options" in stages:
+        loader = load_instrument.InstrumentFinancial(database_name)
+        loader.login(user, password)
+
+        def fundamentals():
+            for symbol in symbols:
+                loader.load(symbol)
+
+        def options():
+            for symbol in symbols:
+                loader.symbol = symbol
+                loader.load_options_and_quotes()
+
+        if "fundamentals" in stages:
+            results.append(run_stage("fundamentals", loader, fundamentals))
+        if "options" in stages:
+            results.append(run_stage("options", loader, options))
+
+    for result in results:
+        result["universe"] = size
+    return results
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark the finance loaders against recorded upstream responses.")
+    parser.add_argument("--database", default="benchmark", help="local database to load into")
+    parser.add_argument("--sizes", default="10", help="comma separated universe sizes")
+    parser.add_argument("--period", default="1y", help="quote period to load")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma separated stages to run")
+    parser.add_argument("--fixtures", default=FIXTURES_PATH, help="recorded responses")
+    parser.add_argument("--record", action="store_true", help="call upstream and record the responses")
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args(argv)
+
+    session = fixture_session(args.fixtures, record=args.record)
+    sessions.set_session(session)
+    sessions.set_session(session, pooled=True)
+    # snapshots stay in memory so every run downloads the screener from the fixtures again
+    gt.set_snapshot_dir(None)
+
+    user = os.getenv("vaultdb_user", "vaultdb")
+    password = os.getenv("vaultdb_password", "test123")
+    stages = [stage.strip() for stage in args.stages.split(",")]
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        results.extend(run(args.database, size, args.period, stages, user, password))
+
+    print(f"{'universe':>8} {'stage':<12} {'seconds':>9} {'rows':>9} {'rows/sec':>10} {'peak rss mb':>12}")
+    for result in results:
+        print(
+            f"{result['universe']:>8} {result['stage']:<12} {result['seconds']:>9} {result['rows']:>9}"
+            f" {result['rows_per_sec']:>10} {result['peak_rss_mb']:>12}"
+        )
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
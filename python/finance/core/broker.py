@@ -0,0 +1,40 @@
+import os
+import threading
+
+# Set up the logger
+import logging
+
+logger = logging.getLogger()
+
+REDIS_URL = os.getenv("redis_url", "redis://redis:6379/0")
+
+_lock = threading.Lock()
+_client = None
+_async_client = None
+
+
+def get_redis():
+    """Return the shared redis client, or None where redis is not installed (e.g. on lambda)."""
+    global _client
+    with _lock:
+        if _client is None:
+            try:
+                import redis
+            except ImportError:
+                logger.debug("redis is not installed, running without it")
+                return None
+            _client = redis.Redis.from_url(REDIS_URL)
+        return _client
+
+
+def get_async_redis():
+    """Return the shared asyncio redis client for the api, or None where redis is not installed."""
+    global _async_client
+    if _async_client is None:
+        try:
+            import redis.asyncio
+        except ImportError:
+            logger.debug("redis is not installed, running without it")
+            return None
+        _async_client = redis.asyncio.Redis.from_url(REDIS_URL)
+    return _async_client
@@ -0,0 +1,121 @@
+# Set up the logger
+import logging
+
+logger = logging.getLogger()
+
+PREFIX = "finance:checkpoint:"
+# a run that has not progressed for a week is not resumed anymore
+EXPIRE_SECONDS = 7 * 24 * 60 * 60
+
+
+def run_id(task_name: str, *parts) -> str:
+    """Id of a run from its task, arguments and request id; passed back to the task it resumes the run."""
+    return ":".join([task_name, *(str(part) for part in parts if part is not None)])
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class Checkpoint:
+    """Durable set of work items a run has completed, kept in redis.
+
+    Items marked done are held back until `commit()`, which the caller runs once the data
+    written for them has been merged. Items are a symbol, or `symbol/part` for work split further.
+    Without a redis client the checkpoint only lives in memory.
+    """
+
+    def __init__(self, run_id: str, client) -> None:
+        self.run_id = run_id
+        self.client = client
+        self.key = PREFIX + run_id
+        self._completed = None
+        self._pending = set()
+
+    def completed(self) -> set:
+        """ """
+        if self._completed is None:
+            self._completed = set()
+            if self.client is not None:
+                self._completed = {_text(item) for item in self.client.smembers(self.key)}
+        return self._completed
+
+    def is_done(self, item: str) -> bool:
+        return item in self.completed() or item in self._pending
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def mark(self, *items: str):
+        """ """
+        self._pending.update(items)
+
+    def discard(self, symbols: set = None):
+        """Forget items marked since the last commit, only those of `symbols` when given, e.g. when their data
+        failed to merge."""
+        if symbols is None:
+            self._pending.clear()
+        else:
+            self._pending = {item for item in self._pending if item.split("/", 1)[0] not in symbols}
+
+    def commit(self):
+        """ """
+        if not self._pending:
+            return
+        if self.client is not None:
+            try:
+                pipeline = self.client.pipeline()
+                pipeline.sadd(self.key, *self._pending)
+                pipeline.expire(self.key, EXPIRE_SECONDS)
+                pipeline.execute()
+            except Exception as ex:
+                logger.error(f"failed to save checkpoint {self.run_id}: {ex}")
+                return
+        self.completed().update(self._pending)
+        self._pending.clear()
+
+    def save(self, write_buffer, min_pending: int = 0):
+        """Flush `write_buffer` and commit what was marked, except the items of symbols whose merges failed.
+
+        Nothing happens while fewer than `min_pending` items are waiting.
+        """
+        if not self._pending or len(self._pending) < min_pending:
+            return
+        write_buffer.flush("checkpoint")
+        failed = write_buffer.failed_owners()
+        if failed:
+            pending = len(self._pending)
+            self.discard(failed)
+            if len(self._pending) < pending:
+                dropped = pending - len(self._pending)
+                logger.error(f"not checkpointing {dropped} items of {self.run_id}, their merge failed")
+        self.commit()
+
+    def clear(self):
+        """ """
+        if self.client is not None:
+            self.client.delete(self.key)
+        self._completed = set()
+        self._pending.clear()
+
+
+def list_checkpoints(client) -> list[dict]:
+    """Return every stored run with the number of items it completed."""
+    if client is None:
+        return []
+    return [
+        {"run_id": _text(key)[len(PREFIX) :], "completed": client.scard(key)}
+        for key in client.scan_iter(match=PREFIX + "*")
+    ]
+
+
+def get_checkpoint(client, run_id: str) -> dict:
+    """ """
+    completed = sorted(Checkpoint(run_id, client).completed())
+    return {"run_id": run_id, "completed": len(completed), "items": completed}
+
+
+def clear_checkpoint(client, run_id: str):
+    """ """
+    Checkpoint(run_id, client).clear()
@@ -0,0 +1,19 @@
+from contextlib import contextmanager
+
+
+@contextmanager
+def data_inheritance(connection):
+    """Read through to the pushed database for the duration of the block."""
+    connection.execute("PRAGMA enable_data_inheritance;")
+    try:
+        yield connection
+    finally:
+        connection.execute("PRAGMA disable_data_inheritance;")
+
+
+def table_exists(connection, table_name: str) -> bool:
+    """ """
+    found = connection.execute(
+        "select count(*) from information_schema.tables where lower(table_name) = lower(?);", [table_name]
+    ).fetchone()
+    return bool(found and found[0])
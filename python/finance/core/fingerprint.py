@@ -0,0 +1,52 @@
+import hashlib
+from datetime import datetime
+
+import pandas as pd
+from finance.core.database import data_inheritance, table_exists
+
+# Set up the logger
+import logging
+
+logger = logging.getLogger()
+
+FINGERPRINT_TABLE = "load_fingerprint"
+# stamped on every load, they would make every frame look changed
+VOLATILE_COLUMNS = ["Date Reported"]
+
+
+def fingerprint(df) -> str:
+    """Return a sha256 over the content, index, columns and dtypes of `df`; None when it can not be hashed."""
+    if isinstance(df, pd.Series):
+        df = df.to_frame()
+    df = df.drop(columns=[column for column in VOLATILE_COLUMNS if column in df.columns])
+    try:
+        digest = hashlib.sha256(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    except TypeError as ex:
+        # e.g. cells holding lists or dicts
+        logger.debug(f"can not fingerprint frame: {ex}")
+        return None
+    digest.update(repr([(str(column), str(dtype)) for column, dtype in df.dtypes.items()]).encode())
+    return digest.hexdigest()
+
+
+def load_fingerprints(connection, symbol: str) -> dict:
+    """Return the fingerprint of the last load of every table of `symbol`."""
+    with data_inheritance(connection):
+        if not table_exists(connection, FINGERPRINT_TABLE):
+            return {}
+        stored = connection.execute(
+            f"select table_name, fingerprint from {FINGERPRINT_TABLE} where symbol = ?;", [symbol.upper()]
+        ).fetchall()
+    return dict(stored)
+
+
+def fingerprint_frame(symbol: str, fingerprints: dict) -> pd.DataFrame:
+    """Rows for `FINGERPRINT_TABLE`, keyed by symbol and table name."""
+    return pd.DataFrame(
+        {
+            "symbol": symbol.upper(),
+            "table_name": list(fingerprints),
+            "fingerprint": list(fingerprints.values()),
+            "loaded_at": datetime.today(),
+        }
+    )
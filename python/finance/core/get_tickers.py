@@ -1,8 +1,13 @@
 from functools import reduce
+import numpy as np
 import pandas as pd
 from enum import Enum
 import io
-import requests
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from finance.core import sessions
 
 _EXCHANGE_LIST = ['nyse', 'nasdaq', 'amex']
 
@@ -12,6 +17,13 @@ _SECTORS_LIST = set(['Consumer Non-Durables', 'Capital Goods', 'Health Care',
        'Consumer Durables', 'Transportation'])
 
 
+# screener snapshots are kept in memory and, when a directory is set, as parquet files
+_SNAPSHOT_TTL = float(os.getenv('finance_screener_snapshot_ttl', 3600))
+_snapshot_dir = os.getenv('finance_screener_snapshot_dir')
+_snapshots = {}
+_snapshot_lock = threading.Lock()
+
+
 # headers and params used to bypass NASDAQ's anti-scraping mechanism in function __exchange2df
 headers = {
     'authority': 'api.nasdaq.com',
@@ -68,26 +80,20 @@ class SectorConstants:
 # get tickers from chosen exchanges (default all) as a list
 def get_tickers(NYSE=True, NASDAQ=True, AMEX=True):
     tickers_list = []
-    if NYSE:
-        tickers_list.extend(__exchange2list('nyse'))
-    if NASDAQ:
-        tickers_list.extend(__exchange2list('nasdaq'))
-    if AMEX:
-        tickers_list.extend(__exchange2list('amex'))
+    for df in __exchange2dfs(__chosen_exchanges(NYSE, NASDAQ, AMEX)).values():
+        tickers_list.extend(__symbols(df))
     return tickers_list
 
 # get tickers from chosen exchanges as Dataframe
 def get_tickers_dataframe(NYSE=True, NASDAQ=True, AMEX=True):
-    tickers_list = []
-    if NYSE:
-        tickers_list.append(get_nyse_tickers())
-    if NASDAQ:
-        tickers_list.append(get_nasdaq_tickers())
-    if AMEX:
-        tickers_list.append(get_amex_tickers())
+    frames = __exchange2dfs(__chosen_exchanges(NYSE, NASDAQ, AMEX))
+    tickers_list = [df.assign(exchange=exchange) for exchange, df in frames.items()]
     result = pd.concat(tickers_list).infer_objects()
     return result
 
+def __chosen_exchanges(NYSE=True, NASDAQ=True, AMEX=True):
+    return [exchange for exchange, chosen in zip(_EXCHANGE_LIST, (NYSE, NASDAQ, AMEX)) if chosen]
+
 def get_nyse_tickers():
     result = __exchange2df('nyse')
     result["exchange"] = "nyse"
@@ -102,96 +108,151 @@ def get_nasdaq_tickers():
     return result
 
 def get_tickers_filtered(mktcap_min=None, mktcap_max=None, sectors=None):
-    tickers_list = []
-    for exchange in _EXCHANGE_LIST:
-        tickers_list.extend(__exchange2list_filtered(exchange, mktcap_min=mktcap_min, mktcap_max=mktcap_max, sectors=sectors))
-    return tickers_list
+    return screen(mktcap_min=mktcap_min, mktcap_max=mktcap_max, sectors=sectors)['symbol'].tolist()
 
 
 def get_biggest_n_tickers(top_n, sectors=None):
-    df = pd.DataFrame()
-    for exchange in _EXCHANGE_LIST:
-        temp = __exchange2df(exchange)
-        df = pd.concat([df, temp])
-        
-    df = df.dropna(subset={'marketCap'})
-    df = df[~df['symbol'].str.contains(r"\.|\^")]
+    return screen(sectors=sectors, top_n=top_n)['symbol'].tolist()
+
 
+# screen the chosen exchanges (default all) by sector and market cap (in millions) with a single mask,
+# returns the matching rows with the parsed market cap in 'marketCapMillions', largest first when top_n is set
+def screen(exchanges=None, sectors=None, mktcap_min=None, mktcap_max=None, top_n=None):
+    exchanges = exchanges or _EXCHANGE_LIST
+    if isinstance(exchanges, str):
+        exchanges = [exchanges]
+    frames = __exchange2dfs(exchanges)
+    df = pd.concat([df.assign(exchange=exchange) for exchange, df in frames.items()], ignore_index=True)
+    df = df.dropna(subset=['marketCap'])
+    df['marketCapMillions'] = __market_cap_millions(df['marketCap'])
+
+    # removes weird tickers
+    mask = ~df['symbol'].str.contains(r"\.|\^")
     if sectors is not None:
         if isinstance(sectors, str):
             sectors = [sectors]
         if not _SECTORS_LIST.issuperset(set(sectors)):
             raise ValueError('Some sectors included are invalid')
-        sector_filter = df['Sector'].apply(lambda x: x in sectors)
-        df = df[sector_filter]
-
-    def cust_filter(mkt_cap):
-        if 'M' in mkt_cap:
-            return float(mkt_cap[1:-1])
-        elif 'B' in mkt_cap:
-            return float(mkt_cap[1:-1]) * 1000
-        else:
-            return float(mkt_cap[1:]) / 1e6
-    df['marketCap'] = df['marketCap'].apply(cust_filter)
-
-    df = df.sort_values('marketCap', ascending=False)
-    if top_n > len(df):
-        raise ValueError('Not enough companies, please specify a smaller top_n')
+        mask &= df['sector'].isin(sectors)
+    if mktcap_min is not None:
+        mask &= df['marketCapMillions'] > mktcap_min
+    if mktcap_max is not None:
+        mask &= df['marketCapMillions'] < mktcap_max
+    df = df[mask]
 
-    return df.iloc[:top_n]['symbol'].tolist()
+    if top_n is not None:
+        if top_n > len(df):
+            raise ValueError('Not enough companies, please specify a smaller top_n')
+        df = df.nlargest(top_n, 'marketCapMillions')
+    return df
 
 
 def get_tickers_by_region(region):
-    if region in Region:
-        response = requests.get('https://old.nasdaq.com/screening/companies-by-name.aspx', headers=headers,
-                                params=params_region(region))
-        data = io.StringIO(response.text)
-        df = pd.read_csv(data, sep=",")
-        return __exchange2list(df)
-    else:
-        raise ValueError('Please enter a valid region (use a Region.REGION as the argument, e.g. Region.AFRICA)')
-
-def __exchange2df(exchange):
-    r = requests.get('https://api.nasdaq.com/api/screener/stocks', headers=headers, params=params(exchange))
+    return get_tickers_by_regions([region])[region]
+
+# get tickers of several regions at once, returns a dict of region to list of tickers
+def get_tickers_by_regions(regions):
+    for region in regions:
+        if region not in Region:
+            raise ValueError('Please enter a valid region (use a Region.REGION as the argument, e.g. Region.AFRICA)')
+    return dict(zip(regions, __fetch_all(__fetch_region, regions)))
+
+def __fetch_region(region):
+    response = sessions.get_pooled_session().get('https://old.nasdaq.com/screening/companies-by-name.aspx',
+                                                 headers=headers, params=params_region(region.value),
+                                                 timeout=sessions.REQUEST_TIMEOUT)
+    response.raise_for_status()
+    df = pd.read_csv(io.StringIO(response.text), sep=",")
+    return __symbols(df.rename(columns={'Symbol': 'symbol'}))
+
+# run fetch for every item concurrently, results come back in the order of items
+def __fetch_all(fetch, items):
+    if len(items) <= 1:
+        return [fetch(item) for item in items]
+    with ThreadPoolExecutor(max_workers=len(items)) as executor:
+        return list(executor.map(fetch, items))
+
+# configure where screener snapshots are persisted (None keeps them in memory only) and how long they stay fresh
+def set_snapshot_dir(path, ttl=None):
+    global _snapshot_dir, _SNAPSHOT_TTL
+    with _snapshot_lock:
+        _snapshot_dir = path
+        if ttl is not None:
+            _SNAPSHOT_TTL = ttl
+        _snapshots.clear()
+
+# download the given exchanges (default all) again and replace their snapshots
+def refresh_snapshot(exchanges=None):
+    exchanges = exchanges or _EXCHANGE_LIST
+    for exchange, df in zip(exchanges, __fetch_all(__fetch_exchange, exchanges)):
+        __store_snapshot(exchange, df)
+
+# drop the in-memory snapshots, the files on disk are kept
+def clear_snapshot():
+    with _snapshot_lock:
+        _snapshots.clear()
+
+def __snapshot_path(exchange):
+    return os.path.join(_snapshot_dir, f'{exchange}.screener.parquet')
+
+def __store_snapshot(exchange, df):
+    fetched_at = time.time()
+    with _snapshot_lock:
+        _snapshots[exchange] = (fetched_at, df)
+        if _snapshot_dir:
+            os.makedirs(_snapshot_dir, exist_ok=True)
+            df.to_parquet(__snapshot_path(exchange), index=False)
+
+def __load_snapshot(exchange):
+    with _snapshot_lock:
+        if exchange in _snapshots:
+            fetched_at, df = _snapshots[exchange]
+            if time.time() - fetched_at < _SNAPSHOT_TTL:
+                return df
+        if _snapshot_dir and os.path.isfile(__snapshot_path(exchange)):
+            fetched_at = os.path.getmtime(__snapshot_path(exchange))
+            if time.time() - fetched_at < _SNAPSHOT_TTL:
+                df = pd.read_parquet(__snapshot_path(exchange))
+                _snapshots[exchange] = (fetched_at, df)
+                return df
+    return None
+
+def __fetch_exchange(exchange):
+    r = sessions.get_pooled_session().get('https://api.nasdaq.com/api/screener/stocks', headers=headers,
+                                          params=params(exchange), timeout=sessions.REQUEST_TIMEOUT)
+    r.raise_for_status()
     data = r.json()['data']
     df = pd.DataFrame(data['rows'], columns=data['headers'])
     return df
 
+# callers modify the frame they get, so always hand out a copy of the snapshot
+def __exchange2df(exchange):
+    return __exchange2dfs([exchange])[exchange]
+
+# snapshots of several exchanges, the missing ones are downloaded concurrently
+def __exchange2dfs(exchanges):
+    frames = {exchange: __load_snapshot(exchange) for exchange in exchanges}
+    missing = [exchange for exchange, df in frames.items() if df is None]
+    for exchange, df in zip(missing, __fetch_all(__fetch_exchange, missing)):
+        __store_snapshot(exchange, df)
+        frames[exchange] = df
+    return {exchange: df.copy() for exchange, df in frames.items()}
+
 def __exchange2list(exchange):
-    df = __exchange2df(exchange)
+    return __symbols(__exchange2df(exchange))
+
+def __symbols(df):
     # removes weird tickers
     df_filtered = df[~df['symbol'].str.contains(r"\.|\^")]
     return df_filtered['symbol'].tolist()
 
-# market caps are in millions
-def __exchange2list_filtered(exchange, mktcap_min=None, mktcap_max=None, sectors=None):
-    df = __exchange2df(exchange)
-    df = df.dropna(subset={'marketCap'})
-    df = df[~df['symbol'].str.contains(r"\.|\^")]
-
-    if sectors is not None:
-        if isinstance(sectors, str):
-            sectors = [sectors]
-        if not _SECTORS_LIST.issuperset(set(sectors)):
-            raise ValueError('Some sectors included are invalid')
-        sector_filter = df['sector'].apply(lambda x: x in sectors)
-        df = df[sector_filter]
-
-    def cust_filter(mkt_cap):
-        if 'M' in mkt_cap:
-            return float(mkt_cap[1:-1])
-        elif 'B' in mkt_cap:
-            return float(mkt_cap[1:-1]) * 1000
-        elif mkt_cap == '':
-            return 0.0
-        else:
-            return float(mkt_cap[1:]) / 1e6
-    df['marketCap'] = df['marketCap'].apply(cust_filter)
-    if mktcap_min is not None:
-        df = df[df['marketCap'] > mktcap_min]
-    if mktcap_max is not None:
-        df = df[df['marketCap'] < mktcap_max]
-    return df['symbol'].tolist()
+# market caps come as '$1.2B', '$350.5M', '$12345' or plain dollars, parse them all into millions at once
+def __market_cap_millions(market_caps):
+    text = market_caps.astype(str).str.strip()
+    value = pd.to_numeric(text.str.replace(r'[$,MB]', '', regex=True), errors='coerce')
+    unit = text.str[-1:]
+    scale = np.select([unit == 'M', unit == 'B'], [1.0, 1000.0], 1 / 1e6)
+    return (value * scale).fillna(0.0)
 
 
 # save the tickers to a CSV
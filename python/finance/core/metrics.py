@@ -0,0 +1,172 @@
+import contextvars
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Set up the logger
+import logging
+
+logger = logging.getLogger()
+
+STAGE_SECONDS = "finance_stage_seconds"
+ROWS = "finance_rows_total"
+BYTES = "finance_bytes_total"
+ERRORS = "finance_errors_total"
+HTTP_REQUESTS = "finance_http_requests_total"
+THROTTLED = "finance_throttled_total"
+UNCHANGED = "finance_unchanged_tables_total"
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, math.inf)
+# every process publishes its snapshot under its own key, dropped a day after the process last ran a task
+KEY_PREFIX = "finance:metrics:"
+EXPIRE_SECONDS = 24 * 60 * 60
+
+HELP = {
+    STAGE_SECONDS: "Latency of extract, transform and merge calls.",
+    ROWS: "Rows handed to sync_load_and_merge.",
+    BYTES: "In-memory bytes handed to sync_load_and_merge.",
+    ERRORS: "Failed extract, transform or merge calls.",
+    HTTP_REQUESTS: "Upstream HTTP responses by host, status and cache result.",
+    THROTTLED: "Upstream responses that were throttled and retried.",
+    UNCHANGED: "Extracted tables not merged because their content did not change.",
+}
+
+_task = contextvars.ContextVar("finance_metrics_task", default="")
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+def set_task(name: str):
+    """Label everything recorded from now on in this context with task `name`."""
+    _task.set(name or "")
+
+
+def current_task() -> str:
+    return _task.get()
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    """ """
+    labels.setdefault("task", current_task())
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels):
+    """ """
+    labels.setdefault("task", current_task())
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.setdefault(key, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+@contextmanager
+def timed(stage: str, table: str):
+    """Record the latency of the block, and count it as an error when it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc(ERRORS, stage=stage, table=table)
+        raise
+    finally:
+        observe(STAGE_SECONDS, time.perf_counter() - started, stage=stage, table=table)
+
+
+def snapshot() -> dict:
+    """Return everything recorded in this process in a json serializable form."""
+    with _lock:
+        return {
+            "counters": [[name, dict(labels), value] for (name, labels), value in _counters.items()],
+            "histograms": [
+                [name, dict(labels), list(h["buckets"]), h["sum"], h["count"]]
+                for (name, labels), h in _histograms.items()
+            ],
+        }
+
+
+def merge(snapshots: list[dict]) -> dict:
+    """Add up snapshots taken in several processes."""
+    counters, histograms = {}, {}
+    for snap in snapshots:
+        for name, labels, value in snap.get("counters", []):
+            key = _key(name, labels)
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, buckets, total, count in snap.get("histograms", []):
+            key = _key(name, labels)
+            merged = histograms.setdefault(key, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0})
+            merged["buckets"] = [a + b for a, b in zip(merged["buckets"], buckets)]
+            merged["sum"] += total
+            merged["count"] += count
+    return {
+        "counters": [[name, dict(labels), value] for (name, labels), value in counters.items()],
+        "histograms": [
+            [name, dict(labels), h["buckets"], h["sum"], h["count"]] for (name, labels), h in histograms.items()
+        ],
+    }
+
+
+def _labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+def render(snap: dict = None) -> str:
+    """Render a snapshot in the prometheus text format."""
+    snap = snap or snapshot()
+    lines, described = [], set()
+
+    def describe(name, kind):
+        if name not in described:
+            described.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for name, labels, value in sorted(snap.get("counters", []), key=lambda c: (c[0], sorted(c[1].items()))):
+        describe(name, "counter")
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for name, labels, buckets, total, count in sorted(
+        snap.get("histograms", []), key=lambda h: (h[0], sorted(h[1].items()))
+    ):
+        describe(name, "histogram")
+        for bound, bucket in zip(BUCKETS, buckets):
+            le = "+Inf" if math.isinf(bound) else repr(bound)
+            lines.append(f"{name}_bucket{_labels(labels, le=le)} {bucket}")
+        lines.append(f"{name}_sum{_labels(labels)} {total}")
+        lines.append(f"{name}_count{_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def publish(client, process_key: str):
+    """Store this process' snapshot in redis so the api can export it."""
+    if client is None:
+        return
+    try:
+        client.set(KEY_PREFIX + process_key, json.dumps(snapshot()), ex=EXPIRE_SECONDS)
+    except Exception as ex:
+        logger.error(f"failed to publish metrics: {ex}")
+
+
+def collect(client) -> dict:
+    """Merge the snapshots every worker published."""
+    if client is None:
+        return snapshot()
+    keys = list(client.scan_iter(match=KEY_PREFIX + "*"))
+    published = client.mget(keys) if keys else []
+    return merge([json.loads(value) for value in published if value is not None])
@@ -0,0 +1,107 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_SHARD_SIZE = 250
+# history years assumed for symbols without an ipo year
+DEFAULT_HISTORY_YEARS = 30
+
+# A symbol belongs to the first tier whose market cap (dollars) or daily volume (shares) it reaches.
+# Each tier is refreshed on its own queue and schedule (crontab fields, UTC); with the redis
+# broker 0 is the highest priority.
+TIERS = [
+    {
+        "name": "core",
+        "min_market_cap": 10_000_000_000,
+        "min_volume": 5_000_000,
+        "queue": "high",
+        "priority": 0,
+        # every 15 minutes while the US market is open
+        "schedule": {"minute": "*/15", "hour": "13-21", "day_of_week": "mon-fri"},
+    },
+    {
+        "name": "active",
+        "min_market_cap": 1_000_000_000,
+        "min_volume": 500_000,
+        "queue": "celery",
+        "priority": 3,
+        "schedule": {"minute": "5", "hour": "13-21", "day_of_week": "mon-fri"},
+    },
+    {
+        "name": "tail",
+        "min_market_cap": 0,
+        "min_volume": 0,
+        "queue": "low",
+        "priority": 9,
+        "schedule": {"minute": "30", "hour": "5", "day_of_week": "tue-sat"},
+    },
+]
+
+
+def get_tier(name: str) -> dict:
+    """ """
+    for tier in TIERS:
+        if tier["name"] == name:
+            return tier
+    raise ValueError(f"Invalid tier {name} allowed values are {', '.join(tier['name'] for tier in TIERS)}.")
+
+
+def assign_tiers(tickers: pd.DataFrame) -> pd.Series:
+    """Return the tier name of every row of `tickers`, from its `marketCap` and `volume` columns."""
+    market_cap = pd.to_numeric(tickers["marketCap"], errors="coerce").fillna(0).to_numpy(dtype="float64")
+    volume = pd.to_numeric(tickers["volume"], errors="coerce").fillna(0).to_numpy(dtype="float64")
+    conditions = [(market_cap >= tier["min_market_cap"]) | (volume >= tier["min_volume"]) for tier in TIERS]
+    names = np.select(conditions, [tier["name"] for tier in TIERS], default=TIERS[-1]["name"])
+    return pd.Series(names, index=tickers.index)
+
+
+def quote_cost(tickers: pd.DataFrame, period: str) -> pd.Series:
+    """Estimate the relative download cost of each symbol's quotes.
+
+    Full history loads are weighted by listed years relative to a typical listing, everything
+    else costs one unit per symbol.
+    """
+    if period != "max" or "ipoyear" not in tickers.columns:
+        return pd.Series(1.0, index=tickers.index)
+    ipoyear = pd.to_numeric(tickers["ipoyear"], errors="coerce")
+    years = (date.today().year - ipoyear).fillna(DEFAULT_HISTORY_YEARS)
+    return years.clip(lower=1.0) / DEFAULT_HISTORY_YEARS
+
+
+def plan_shards(symbols: list[str], shard_size: int = DEFAULT_SHARD_SIZE, costs: list[float] = None) -> list[list[str]]:
+    """Split symbols into shards of `shard_size` symbols, or of about `shard_size` cost units when `costs` is given.
+
+    Costed shards are packed greedily in symbol order so neighbouring symbols stay together.
+    """
+    if costs is None:
+        return [symbols[i : i + shard_size] for i in range(0, len(symbols), shard_size)]
+
+    shards = []
+    shard, shard_cost = [], 0.0
+    for symbol, cost in zip(symbols, costs):
+        if shard and shard_cost + cost > shard_size:
+            shards.append(shard)
+            shard, shard_cost = [], 0.0
+        shard.append(symbol)
+        shard_cost += cost
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+def summarize(results: list[dict]) -> dict:
+    """Combine per-shard result dictionaries into one run summary."""
+    summary = {"shards": len(results), "symbols": 0, "rows": 0, "failed": [], "writes": {}}
+    for result in results:
+        if not result:
+            continue
+        summary["symbols"] += result.get("symbols", 0)
+        summary["rows"] += result.get("rows", 0)
+        for name in ("unchanged", "indicators", "contracts"):
+            if name in result:
+                summary[name] = summary.get(name, 0) + result[name]
+        summary["failed"].extend(result.get("failed", []))
+        for name, value in result.get("writes", {}).items():
+            summary["writes"][name] = summary["writes"].get(name, 0) + value
+    return summary
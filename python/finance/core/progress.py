@@ -0,0 +1,100 @@
+import json
+import time
+
+# Set up the logger
+import logging
+
+logger = logging.getLogger()
+
+# progress is kept for a day after the last update
+EXPIRE_SECONDS = 24 * 60 * 60
+
+
+def channel(task_id: str) -> str:
+    return f"finance:progress:{task_id}"
+
+
+def counters_key(task_id: str) -> str:
+    return f"finance:progress:{task_id}:counters"
+
+
+def last_event_key(task_id: str) -> str:
+    return f"finance:progress:{task_id}:last"
+
+
+def decode(message) -> dict:
+    if message is None:
+        return None
+    return json.loads(message.decode() if isinstance(message, bytes) else message)
+
+
+def build_event(task_id: str, counters: dict) -> dict:
+    """Turn the counters of a run into a progress event with an ETA."""
+    counters = {(k.decode() if isinstance(k, bytes) else k): float(v) for k, v in counters.items()}
+    total = int(counters.get("total", 0))
+    done = int(counters.get("symbols", 0))
+    started = counters.get("started", time.time())
+    elapsed = max(time.time() - started, 0.0)
+    if total and done >= total:
+        eta = 0.0
+    elif done:
+        eta = elapsed / done * (total - done)
+    else:
+        eta = None
+    return {
+        "task_id": task_id,
+        "symbols_done": done,
+        "symbols_total": total,
+        "rows": int(counters.get("rows", 0)),
+        "errors": int(counters.get("errors", 0)),
+        "elapsed_seconds": round(elapsed, 1),
+        "eta_seconds": None if eta is None else round(eta, 1),
+        "finished": bool(counters.get("finished", 0)),
+    }
+
+
+class ProgressReporter:
+    """Publish progress of a run over redis pub/sub.
+
+    Counters live in a redis hash so every shard of a run can advance the same progress.
+    Without a redis client every call is a no-op.
+    """
+
+    def __init__(self, task_id: str, client) -> None:
+        self.task_id = task_id
+        self.client = client
+
+    def start(self, total: int):
+        """ """
+        self._update({"total": total, "started": time.time()})
+
+    def advance(self, symbols: int = 0, rows: int = 0, errors: int = 0):
+        """ """
+        self._update(increments={"symbols": symbols, "rows": rows, "errors": errors})
+
+    def finish(self, **summary):
+        """ """
+        self._update({"finished": 1}, extra=summary)
+
+    def _update(self, values: dict = None, increments: dict = None, extra: dict = None):
+        if self.client is None or not self.task_id:
+            return
+        key = counters_key(self.task_id)
+        try:
+            pipeline = self.client.pipeline()
+            if values:
+                pipeline.hset(key, mapping=values)
+            for field, amount in (increments or {}).items():
+                if amount:
+                    pipeline.hincrbyfloat(key, field, amount)
+            pipeline.expire(key, EXPIRE_SECONDS)
+            pipeline.hgetall(key)
+            counters = pipeline.execute()[-1]
+            event = build_event(self.task_id, counters)
+            if extra:
+                event["summary"] = extra
+            message = json.dumps(event, default=str)
+            self.client.set(last_event_key(self.task_id), message, ex=EXPIRE_SECONDS)
+            self.client.publish(channel(self.task_id), message)
+        except Exception as ex:
+            logger.error(f"failed to publish progress for {self.task_id}: {ex}")
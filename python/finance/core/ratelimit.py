@@ -0,0 +1,192 @@
+import os
+import threading
+import time
+
+from finance.core import broker
+
+# Set up the logger
+import logging
+
+logger = logging.getLogger()
+
+# cluster-wide requests per second for each upstream
+YAHOO_RATE = float(os.getenv("finance_yahoo_rate", 10))
+NASDAQ_RATE = float(os.getenv("finance_nasdaq_rate", 2))
+# the rate is never cut below this
+MIN_RATE = 0.2
+# a throttled upstream halves the rate, which then grows back to the limit over this many seconds
+DECREASE_FACTOR = 0.5
+RECOVERY_SECONDS = 60.0
+# concurrent throttled responses only cut the rate once per this many seconds
+DECREASE_INTERVAL = 1.0
+# seconds a process keeps to its own bucket after redis failed
+FALLBACK_SECONDS = 60.0
+KEY_PREFIX = "finance:ratelimit:"
+EXPIRE_SECONDS = 60 * 60
+
+# host suffix -> (bucket name, requests per second)
+LIMITS = {
+    "finance.yahoo.com": ("yahoo", YAHOO_RATE),
+    "fc.yahoo.com": ("yahoo", YAHOO_RATE),
+    "nasdaq.com": ("nasdaq", NASDAQ_RATE),
+}
+
+# Every caller takes a token, the balance may go negative: the wait returned is the caller's place in line.
+# KEYS[1] bucket, ARGV: now, max rate, burst, recovery per second
+_ACQUIRE = """
+local now = tonumber(ARGV[1])
+local max_rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local recovery = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+local rate = tonumber(state[3]) or max_rate
+local elapsed = math.max(0, now - ts)
+rate = math.min(max_rate, rate + recovery * elapsed)
+tokens = math.min(burst, tokens + elapsed * rate) - 1
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now, 'rate', rate)
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+# KEYS[1] bucket, ARGV: now, max rate, min rate, factor, decrease interval, pause seconds, expire
+_DECREASE = """
+local now = tonumber(ARGV[1])
+local state = redis.call('HMGET', KEYS[1], 'rate', 'decreased', 'tokens')
+local rate = tonumber(state[1]) or tonumber(ARGV[2])
+local decreased = tonumber(state[2]) or 0
+local tokens = tonumber(state[3]) or 0
+if now - decreased >= tonumber(ARGV[5]) then
+    rate = math.max(tonumber(ARGV[3]), rate * tonumber(ARGV[4]))
+    redis.call('HSET', KEYS[1], 'rate', rate, 'decreased', now)
+end
+local pause = tonumber(ARGV[6])
+if pause > 0 then
+    redis.call('HSET', KEYS[1], 'tokens', math.min(tokens, -pause * rate), 'ts', now)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[7])
+return tostring(rate)
+"""
+
+
+class TokenBucket:
+    """In-process token bucket with the same adaptive behaviour as the redis one."""
+
+    def __init__(self, max_rate: float, burst: float) -> None:
+        self.max_rate = max_rate
+        self.burst = burst
+        self.rate = max_rate
+        self.tokens = burst
+        self.ts = time.time()
+        self.decreased = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, now: float) -> float:
+        with self._lock:
+            elapsed = max(0.0, now - self.ts)
+            self.rate = min(self.max_rate, self.rate + self.max_rate / RECOVERY_SECONDS * elapsed)
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate) - 1
+            self.ts = now
+            return max(0.0, -self.tokens / self.rate)
+
+    def decrease(self, now: float, pause: float = 0.0) -> float:
+        with self._lock:
+            if now - self.decreased >= DECREASE_INTERVAL:
+                self.rate = max(MIN_RATE, self.rate * DECREASE_FACTOR)
+                self.decreased = now
+            if pause > 0:
+                self.tokens = min(self.tokens, -pause * self.rate)
+                self.ts = now
+            return self.rate
+
+
+class RateLimiter:
+    """Adaptive token bucket shared by every worker through redis.
+
+    The bucket falls back to this process alone when redis is not installed or not reachable.
+    """
+
+    def __init__(self, name: str, max_rate: float, burst: float = None, client=None) -> None:
+        self.name = name
+        self.key = KEY_PREFIX + name
+        self.max_rate = max_rate
+        self.burst = burst or max(1.0, max_rate)
+        self.client = client
+        self.local = TokenBucket(self.max_rate, self.burst)
+        self._scripts = None
+        self._fallback_until = 0.0
+
+    def _redis(self):
+        if self.client is None or time.time() < self._fallback_until:
+            return None
+        if self._scripts is None:
+            self._scripts = (self.client.register_script(_ACQUIRE), self.client.register_script(_DECREASE))
+        return self._scripts
+
+    def _fallback(self, ex: Exception):
+        logger.error(f"rate limiter {self.name} falls back to this process for {FALLBACK_SECONDS} s: {ex}")
+        self._fallback_until = time.time() + FALLBACK_SECONDS
+
+    def acquire(self) -> float:
+        """Wait for a token and return the seconds waited."""
+        now = time.time()
+        wait = None
+        scripts = self._redis()
+        if scripts:
+            try:
+                wait = float(
+                    scripts[0](
+                        keys=[self.key],
+                        args=[now, self.max_rate, self.burst, self.max_rate / RECOVERY_SECONDS, EXPIRE_SECONDS],
+                    )
+                )
+            except Exception as ex:
+                self._fallback(ex)
+        if wait is None:
+            wait = self.local.acquire(now)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self, retry_after: float = 0.0) -> float:
+        """Cut the rate after a throttled response; `retry_after` seconds pause every caller."""
+        now = time.time()
+        scripts = self._redis()
+        if scripts:
+            try:
+                return float(
+                    scripts[1](
+                        keys=[self.key],
+                        args=[
+                            now,
+                            self.max_rate,
+                            MIN_RATE,
+                            DECREASE_FACTOR,
+                            DECREASE_INTERVAL,
+                            retry_after,
+                            EXPIRE_SECONDS,
+                        ],
+                    )
+                )
+            except Exception as ex:
+                self._fallback(ex)
+        return self.local.decrease(now, retry_after)
+
+
+_lock = threading.Lock()
+_limiters = {}
+
+
+def for_host(host: str) -> RateLimiter:
+    """Return the limiter of the upstream `host` belongs to, None for hosts that are not limited."""
+    for suffix, (name, rate) in LIMITS.items():
+        if host == suffix or host.endswith("." + suffix):
+            with _lock:
+                if name not in _limiters:
+                    _limiters[name] = RateLimiter(name, rate, client=broker.get_redis())
+                return _limiters[name]
+    return None
@@ -0,0 +1,103 @@
+import pandas as pd
+
+# Strings are stored as arrow backed strings rather than categoricals: duckdb creates ENUM
+# columns from pandas categoricals, which would reject symbols not seen in the first load.
+STRING = "string[pyarrow]"
+
+# column dtypes applied before a frame is merged, prices stay float64 since float32 can not hold
+# cents on high priced shares
+TABLE_SCHEMAS = {
+    "quote": {
+        "symbol": STRING,
+        "Volume": "int64",
+        "Dividends": "float32",
+        "Stock Splits": "float32",
+        "Capital Gains": "float32",
+        "openinterest": "float32",
+        "impliedvolatility": "float32",
+    },
+    "tickers": {
+        "exchange": STRING,
+        "symbol": STRING,
+        "name": STRING,
+        "country": STRING,
+        "industry": STRING,
+        "sector": STRING,
+        "url": STRING,
+    },
+    "indicators": {
+        "symbol": STRING,
+    },
+    "option_greeks": {
+        "symbol": STRING,
+        "underlying": STRING,
+        "type": STRING,
+    },
+    "iv_surface": {
+        "underlying": STRING,
+    },
+    "option_chain": {
+        "symbol": STRING,
+        "underlying": STRING,
+        "currency": STRING,
+        "type": STRING,
+    },
+}
+
+# intraday bars have the columns of daily bars and the interval they were sampled at
+TABLE_SCHEMAS["quote_intraday"] = {**TABLE_SCHEMAS["quote"], "interval": STRING}
+
+# integer columns can not hold missing values
+FILL_VALUES = {"int64": 0}
+
+
+def apply_schema(df: pd.DataFrame, table_name: str) -> pd.DataFrame:
+    """Cast a frame to the compact dtypes declared for `table_name`, or to `compact_frame` when none are declared."""
+    schema = TABLE_SCHEMAS.get(table_name)
+    if schema is None:
+        return compact_frame(df)
+    dtypes = {column.lower(): dtype for column, dtype in schema.items()}
+    casts, fills = {}, {}
+    for column in df.columns:
+        dtype = dtypes.get(str(column).lower())
+        if dtype is None or str(df[column].dtype) == dtype:
+            continue
+        if dtype in FILL_VALUES:
+            fills[column] = FILL_VALUES[dtype]
+        casts[column] = dtype
+    if fills:
+        df = df.fillna(fills)
+    if casts:
+        df = df.astype(casts)
+    return normalize_timestamps(df)
+
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Use arrow strings for text columns of tables without a declared schema.
+
+    Numeric columns keep their dtype: the first load creates the table, and a float column narrowed
+    because its first values happened to fit would round every later value.
+    """
+    casts = {}
+    for column in df.columns:
+        values = df[column]
+        if values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) == "string":
+            casts[column] = STRING
+    if casts:
+        df = df.astype(casts)
+    return normalize_timestamps(df)
+
+
+def normalize_timestamps(df: pd.DataFrame) -> pd.DataFrame:
+    """Store every timestamp column with microsecond resolution, the unit duckdb keeps."""
+    columns = [
+        column
+        for column in df.columns
+        if pd.api.types.is_datetime64_any_dtype(df[column]) and getattr(df[column].dt, "unit", "us") != "us"
+    ]
+    if columns:
+        df = df.copy(deep=False)
+        for column in columns:
+            df[column] = df[column].dt.as_unit("us")
+    return df
+
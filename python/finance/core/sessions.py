@@ -0,0 +1,233 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+import requests
+import requests_cache
+from urllib3.util.retry import Retry
+from finance.core import metrics, ratelimit
+
+# Set up the logger
+import logging
+
+logger = logging.getLogger()
+
+USER_AGENT = "my-program/1.0"
+
+# local to the host by default, sqlite over a network mount (e.g. EFS on lambda) is not safe to share
+CACHE_PATH = os.getenv("finance_http_cache", os.path.join(tempfile.gettempdir(), "finance.http.cache"))
+CACHE_MAX_BYTES = int(os.getenv("finance_http_cache_max_bytes", 512 * 1024 * 1024))
+POOL_SIZE = int(os.getenv("finance_http_pool_size", 32))
+# (connect, read) seconds, requests has no session-wide timeout so callers pass it explicitly
+REQUEST_TIMEOUT = (5, 30)
+# connection errors are retried by urllib3, throttled responses by ThrottledAdapter so retries take a token too
+RETRIES = Retry(total=3, backoff_factor=0.5)
+THROTTLED_STATUS = (429, 500, 502, 503, 504)
+STATUS_RETRIES = 4
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+
+# quotes move during the session, fundamentals change a few times a year
+QUOTES_TTL = timedelta(minutes=15)
+FUNDAMENTALS_TTL = timedelta(hours=24)
+DEFAULT_TTL = timedelta(hours=1)
+# every worker process publishes its cache stats under its own key, dropped once the process is gone
+STATS_KEY_PREFIX = "finance:http_cache:"
+STATS_EXPIRE_SECONDS = 24 * 60 * 60
+
+URLS_EXPIRE_AFTER = {
+    "*.finance.yahoo.com/v8/finance/chart": QUOTES_TTL,
+    "*.finance.yahoo.com/v7/finance/options": QUOTES_TTL,
+    "*.finance.yahoo.com/v7/finance/quote": QUOTES_TTL,
+    "*.finance.yahoo.com/v10/finance/quoteSummary": FUNDAMENTALS_TTL,
+    "*.finance.yahoo.com/ws/fundamentals-timeseries": FUNDAMENTALS_TTL,
+    "*.finance.yahoo.com/v1/finance/search": FUNDAMENTALS_TTL,
+    "*.finance.yahoo.com/calendar/earnings": FUNDAMENTALS_TTL,
+}
+
+_lock = threading.Lock()
+_session = None
+_pooled_session = None
+_stats = {"hits": 0, "misses": 0}
+
+
+def _record(response, cache: str):
+    host = urlsplit(response.url).hostname or ""
+    metrics.inc(metrics.HTTP_REQUESTS, host=host, status=response.status_code, cache=cache)
+    if response.status_code >= 400 and cache != "hits":
+        metrics.inc(metrics.ERRORS, stage="upstream", table=host)
+
+
+def _count(response, *args, **kwargs):
+    key = "hits" if getattr(response, "from_cache", False) else "misses"
+    with _lock:
+        _stats[key] += 1
+    _record(response, key)
+    return response
+
+
+def _count_uncached(response, *args, **kwargs):
+    # responses of the pooled session are not cache misses, they never go through the cache
+    _record(response, "uncached")
+    return response
+
+
+def _retry_after(response) -> float:
+    try:
+        return min(float(response.headers.get("Retry-After", 0)), MAX_BACKOFF_SECONDS)
+    except ValueError:
+        # an http date, fall back to the backoff
+        return 0.0
+
+
+class ThrottledAdapter(requests.adapters.HTTPAdapter):
+    """Take a token from the upstream's rate limiter before every request.
+
+    Throttled responses cut the shared rate and are retried with jittered exponential backoff;
+    the last one is returned to the caller. Responses served from the cache never reach the adapter.
+    """
+
+    def send(self, request, *args, **kwargs):
+        host = urlsplit(request.url).hostname or ""
+        limiter = ratelimit.for_host(host)
+        attempt = 0
+        while True:
+            if limiter:
+                limiter.acquire()
+            response = super().send(request, *args, **kwargs)
+            if response.status_code not in THROTTLED_STATUS or attempt >= STATUS_RETRIES:
+                return response
+            retry_after = _retry_after(response)
+            if limiter:
+                limiter.throttled(retry_after)
+            metrics.inc(metrics.THROTTLED, host=host, status=response.status_code)
+            backoff = random.uniform(0, min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2**attempt))
+            logger.warning(f"{host} returned {response.status_code}, retrying in {max(backoff, retry_after):.1f} s")
+            response.close()
+            time.sleep(max(backoff, retry_after))
+            attempt += 1
+
+
+def _mount_pool(session: requests.Session, adapter: requests.adapters.HTTPAdapter = None):
+    adapter = adapter or ThrottledAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=RETRIES)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+
+def get_session() -> requests_cache.CachedSession:
+    """Return the process-wide cached session shared by every extract call."""
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests_cache.CachedSession(
+                CACHE_PATH,
+                backend="sqlite",
+                expire_after=DEFAULT_TTL,
+                urls_expire_after=URLS_EXPIRE_AFTER,
+                stale_if_error=True,
+                # the crumb changes with every session, it must not split the cache key
+                ignored_parameters=["crumb"],
+            )
+            session.headers["User-agent"] = USER_AGENT
+            _mount_pool(session)
+            session.hooks["response"].append(_count)
+            _session = session
+        return _session
+
+
+def get_pooled_session() -> requests.Session:
+    """Return the process-wide keep-alive session for uncached calls, with bounded retries."""
+    global _pooled_session
+    with _lock:
+        if _pooled_session is None:
+            session = requests.Session()
+            _mount_pool(session)
+            session.hooks["response"].append(_count_uncached)
+            _pooled_session = session
+        return _pooled_session
+
+
+def set_session(session: requests.Session, pooled: bool = False):
+    """Replace the shared session, e.g. with a fixture replay session."""
+    global _session, _pooled_session
+    with _lock:
+        if pooled:
+            _pooled_session = session
+        else:
+            _session = session
+
+
+def cache_stats() -> dict:
+    """Return cache hit/miss counts since process start and the cache size in bytes."""
+    with _lock:
+        stats = dict(_stats)
+    stats["size_bytes"] = cache_size()
+    return stats
+
+
+def cache_size() -> int:
+    """Return the size in bytes of the sqlite file behind the shared session, 0 for other backends."""
+    # requests_cache only adds the .sqlite suffix to paths without an extension, ask it for the path
+    path = getattr(getattr(get_session(), "cache", None), "db_path", None)
+    return os.path.getsize(path) if path and os.path.isfile(path) else 0
+
+
+def publish_stats(client, process_key: str):
+    """Store this process' cache stats in redis so the api can report every worker."""
+    if client is None:
+        return
+    try:
+        client.set(STATS_KEY_PREFIX + process_key, json.dumps(cache_stats()), ex=STATS_EXPIRE_SECONDS)
+    except Exception as ex:
+        logger.error(f"failed to publish http cache stats: {ex}")
+
+
+def collect_stats(client) -> dict:
+    """Add up the cache stats every worker published, counting the cache file of each host once."""
+    if client is None:
+        return cache_stats()
+    keys = list(client.scan_iter(match=STATS_KEY_PREFIX + "*"))
+    stats = {"hits": 0, "misses": 0, "size_bytes": 0, "processes": 0}
+    sizes = {}
+    for key, value in zip(keys, client.mget(keys) if keys else []):
+        if value is None:
+            continue
+        published = json.loads(value)
+        stats["hits"] += published.get("hits", 0)
+        stats["misses"] += published.get("misses", 0)
+        stats["processes"] += 1
+        # process keys are host:pid, the processes of a host share its cache file
+        host = (key.decode() if isinstance(key, bytes) else key)[len(STATS_KEY_PREFIX) :].rsplit(":", 1)[0]
+        sizes[host] = max(sizes.get(host, 0), published.get("size_bytes", 0))
+    stats["size_bytes"] = sum(sizes.values())
+    return stats
+
+
+def evict(max_bytes: int = CACHE_MAX_BYTES) -> int:
+    """Drop expired responses, then the oldest ones until the cache fits in `max_bytes`.
+
+    Returns the number of responses removed. Errors are logged, loads that already merged their rows
+    must not fail because of the cache.
+    """
+    try:
+        cache = get_session().cache
+        before = len(cache.responses)
+        cache.delete(expired=True)
+        if cache_size() > max_bytes:
+            # remove the responses that expire first, a tenth of the cache at a time
+            while cache_size() > max_bytes and len(cache.responses):
+                batch = max(1, len(cache.responses) // 10)
+                keys = [response.cache_key for response in cache.responses.sorted(key="expires", limit=batch)]
+                cache.delete(*keys, vacuum=True)
+        removed = before - len(cache.responses)
+    except Exception as ex:
+        logger.error(f"failed to evict http cache responses: {ex}")
+        return 0
+    if removed:
+        logger.info(f"evicted {removed} cached responses, cache is {cache_size()} bytes")
+    return removed
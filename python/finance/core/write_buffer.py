@@ -0,0 +1,227 @@
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import pandas as pd
+from finance.core import metrics
+from finance.core.schema import apply_schema
+
+# Set up the logger
+import logging
+
+logger = logging.getLogger()
+
+DEFAULT_MAX_ROWS = 50_000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_AGE = 30.0
+
+
+class WriteBuffer:
+    """Collect small frames per target table and merge them together.
+
+    Frames for the same table, primary keys and partition are concatenated and handed to
+    `merge` once the buffered rows, bytes or the age of the oldest frame cross a threshold,
+    and again on `flush()`. When a combined merge fails its frames are merged one by one, so
+    one bad frame only fails the symbols it was added for, see `failed_owners()`. A frame's
+    `on_merged` callback runs once its rows were merged, writes it buffers go out in the same flush.
+    """
+
+    def __init__(
+        self,
+        merge,
+        max_rows: int = DEFAULT_MAX_ROWS,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        max_age: float = DEFAULT_MAX_AGE,
+    ) -> None:
+        self.merge = merge
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._stats = Counter()
+        self._failed_owners = set()
+
+    def add(
+        self,
+        df: pd.DataFrame,
+        table_name: str,
+        primary_keys: list[str],
+        partition_by: str = None,
+        owners: list[str] = None,
+        on_merged=None,
+    ):
+        """Buffer `df`; `owners` are the symbols reported as failed when its rows can not be merged."""
+        if df is None or df.empty:
+            if on_merged:
+                on_merged()
+            return
+        key = (table_name, tuple(primary_keys or []), partition_by)
+        with self._lock:
+            pending = self._pending.setdefault(
+                key, {"frames": [], "owners": [], "callbacks": [], "rows": 0, "bytes": 0, "since": time.monotonic()}
+            )
+            pending["frames"].append(df)
+            pending["owners"].append(list(owners or []))
+            pending["callbacks"].append(on_merged)
+            pending["rows"] += len(df)
+            pending["bytes"] += int(df.memory_usage(index=False, deep=True).sum())
+            self._stats["frames"] += 1
+
+            if pending["rows"] >= self.max_rows:
+                self._flush(key, "rows")
+            elif pending["bytes"] >= self.max_bytes:
+                self._flush(key, "bytes")
+            elif time.monotonic() - pending["since"] >= self.max_age:
+                self._flush(key, "age")
+
+    def flush(self, reason: str = "explicit"):
+        """Merge everything that is buffered."""
+        with self._lock:
+            # callbacks of merged frames may buffer more rows, e.g. fingerprints of what was merged
+            while self._pending:
+                for key in list(self._pending):
+                    self._flush(key, reason)
+
+    def stats(self) -> dict:
+        """Return flush counters and what is still pending."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending_rows"] = sum(pending["rows"] for pending in self._pending.values())
+            stats["pending_tables"] = len(self._pending)
+        return stats
+
+    def failed_owners(self) -> set:
+        """Return the owners of every frame that failed to merge so far."""
+        with self._lock:
+            return set(self._failed_owners)
+
+    def _flush(self, key, reason: str):
+        pending = self._pending.pop(key, None)
+        if not pending:
+            return
+        table_name, primary_keys, partition_by = key
+        frames = pending["frames"]
+        df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+        df = combine_duplicates(df, primary_keys)
+        try:
+            self.merge(df, table_name, list(primary_keys), partition_by)
+            merged, failed, callbacks = [(df, pending["bytes"])], [], pending["callbacks"]
+        except Exception as ex:
+            if len(frames) == 1:
+                logger.error(f"failed to merge {len(df)} buffered rows into {table_name}: {ex}")
+                merged, failed, callbacks = [], [(df, pending["owners"][0])], []
+            else:
+                logger.warning(f"failed to merge {len(df)} rows into {table_name}, retrying frame by frame: {ex}")
+                merged, failed, callbacks = self._merge_frames(table_name, primary_keys, partition_by, pending)
+        self._stats["flushes"] += 1
+        self._stats[f"flushes_{reason}"] += 1
+        self._stats["rows"] += sum(len(frame) for frame, _ in merged)
+        self._stats["bytes"] += sum(size for _, size in merged)
+        if failed:
+            self._stats["failed_flushes"] += 1
+            self._stats["failed_frames"] += len(failed)
+            self._stats["failed_rows"] += sum(len(frame) for frame, _ in failed)
+            for _, owners in failed:
+                self._failed_owners.update(owners)
+        for on_merged in callbacks:
+            if on_merged is None:
+                continue
+            try:
+                on_merged()
+            except Exception as ex:
+                logger.error(f"callback after merging into {table_name} failed: {ex}")
+
+    def _merge_frames(self, table_name: str, primary_keys: tuple, partition_by: str, pending: dict):
+        merged, failed, callbacks = [], [], []
+        for frame, owners, on_merged in zip(pending["frames"], pending["owners"], pending["callbacks"]):
+            frame = combine_duplicates(frame, primary_keys)
+            try:
+                self.merge(frame, table_name, list(primary_keys), partition_by)
+                merged.append((frame, int(frame.memory_usage(index=False, deep=True).sum())))
+                callbacks.append(on_merged)
+            except Exception as ex:
+                logger.error(f"failed to merge {len(frame)} rows of {', '.join(owners) or '?'} into {table_name}: {ex}")
+                failed.append((frame, owners))
+        return merged, failed, callbacks
+
+
+def combine_duplicates(df: pd.DataFrame, primary_keys) -> pd.DataFrame:
+    """Collapse rows sharing a primary key into one, keeping the latest value present in every column.
+
+    A merge can not take the same key twice. Combining rather than keeping the last row lets e.g.
+    the last trade snapshot of an option contract, which has no open, high or low, update the
+    daily bar of the same date instead of replacing it.
+    """
+    if not primary_keys:
+        return df
+    columns = {str(column).lower(): column for column in df.columns}
+    subset = [columns.get(pk.lower(), pk) for pk in primary_keys]
+    if not all(column in df.columns for column in subset):
+        return df
+    duplicated = df.duplicated(subset=subset, keep=False)
+    if not duplicated.any():
+        return df
+    combined = df[duplicated].groupby(subset, sort=False, dropna=False).last().reset_index()
+    return pd.concat([df[~duplicated], combined], ignore_index=True)[df.columns]
+
+
+class BufferedMerge:
+    """Mixin for VaultDB loaders that casts frames to their compact schema and routes `sync_load_and_merge`
+    through a `WriteBuffer` while one is active."""
+
+    write_buffer: WriteBuffer = None
+
+    @contextmanager
+    def buffered(self, **thresholds):
+        """Buffer merges for the duration of the block and flush on exit."""
+        if self.write_buffer is not None:
+            yield self.write_buffer
+            return
+        self.write_buffer = WriteBuffer(self._merge, **thresholds)
+        try:
+            yield self.write_buffer
+        finally:
+            write_buffer, self.write_buffer = self.write_buffer, None
+            write_buffer.flush("exit")
+            logger.info(f"write buffer stats: {write_buffer.stats()}")
+
+    def sync_load_and_merge(
+        self,
+        df: pd.DataFrame,
+        table_name: str,
+        primary_keys: list[str],
+        partition_by: str = None,
+        on_merged=None,
+        owners: list[str] = None,
+    ):
+        """Merge `df`, or buffer it while a write buffer is active; `on_merged` is called once it was merged."""
+        df = apply_schema(df, table_name)
+        if self.write_buffer is None:
+            result = self._merge(df, table_name, primary_keys, partition_by)
+            if on_merged:
+                on_merged()
+            return result
+        self.write_buffer.add(
+            df, table_name, primary_keys, partition_by, owners=owners or self._owners(df), on_merged=on_merged
+        )
+
+    def _owners(self, df: pd.DataFrame) -> list[str]:
+        # option analytics span several underlyings, other frames belong to the loader's symbol or their rows'
+        columns = {str(column).lower(): column for column in df.columns}
+        if "underlying" in columns:
+            return sorted(df[columns["underlying"]].dropna().unique().tolist())
+        symbol = getattr(self, "symbol", None)
+        if symbol:
+            return [symbol]
+        if "symbol" in columns:
+            return sorted(df[columns["symbol"]].dropna().unique().tolist())
+        return []
+
+    def _merge(self, df: pd.DataFrame, table_name: str, primary_keys: list[str], partition_by: str = None):
+        with metrics.timed("merge", table_name):
+            result = super().sync_load_and_merge(df, table_name, primary_keys, partition_by)
+        metrics.inc(metrics.ROWS, len(df), table=table_name)
+        metrics.inc(metrics.BYTES, int(df.memory_usage(index=False, deep=True).sum()), table=table_name)
+        return result
@@ -0,0 +1,177 @@
+import os
+import tempfile
+from datetime import date, datetime
+
+import duckdb
+import pandas as pd
+from vaultdb import VaultDB
+from finance.core import metrics
+from finance.core.database import data_inheritance, table_exists
+from finance.core.write_buffer import BufferedMerge
+
+# Set up the logger
+import logging
+
+logger = logging.getLogger()
+
+# local directory or object storage url, e.g. s3://bucket/finance
+EXPORT_ROOT = os.getenv(
+    "finance_export_root", os.path.join(os.getenv("commitlog_directory", tempfile.gettempdir()), "export")
+)
+# checksum of every exported partition, a partition is written again when its checksum changed
+STATE_TABLE = "export_partitions"
+# exported tables, each partitioned by symbol and the year of its date column
+EXPORT_TABLES = [
+    "quote",
+    "income_statement",
+    "quarterly_income_statement",
+    "balance_sheet",
+    "quarterly_balance_sheet",
+    "cashflow",
+    "quarterly_cashflow",
+]
+HIVE_TYPES = "{'symbol': VARCHAR, 'year': INTEGER}"
+# every partition is one file with a fixed name, so writing a partition again replaces it
+PARTITION_FILE = "data_{i}"
+
+
+def _literal(value) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def table_path(root: str, table_name: str) -> str:
+    return f"{root.rstrip('/')}/{table_name}"
+
+
+class ParquetExport(BufferedMerge, VaultDB):
+    """Export the tables to Hive partitioned Parquet under `root/table/symbol=/year=`.
+
+    Every run compares a checksum of each partition with the one it was last exported with and
+    rewrites the partitions that changed, so new symbols, reloaded days and adjusted history are
+    picked up, and a run repeated after a failure writes the same files again.
+    """
+
+    def exported(self, table_name: str, root: str) -> pd.DataFrame:
+        """Return the checksum of every partition of `table_name` last exported to `root`."""
+        with data_inheritance(self.connection):
+            if not table_exists(self.connection, STATE_TABLE):
+                return pd.DataFrame(columns=["symbol", "year", "checksum"])
+            return self.connection.execute(
+                f"select symbol, year, checksum from {STATE_TABLE} where table_name = ? and root = ?;",
+                [table_name, root],
+            ).fetchdf()
+
+    def partitions(self, table_name: str, before: date) -> pd.DataFrame:
+        """Return the rows and checksum of every partition of `table_name` with rows dated before `before`.
+
+        Only symbols listed in `tickers` are exported, `quote` also holds the bars of option contracts.
+        """
+        underlyings = "and symbol in (select symbol from tickers)" if table_exists(self.connection, "tickers") else ""
+        return self.connection.execute(
+            f"""
+            select symbol, year(date) as year, count(*) as rows,
+                cast(sum(hash(exported_row)) as varchar) as checksum
+            from {table_name} exported_row
+            where date < ? {underlyings}
+            group by all;
+            """,
+            [before],
+        ).fetchdf()
+
+    def export_table(self, table_name: str, root: str = EXPORT_ROOT, previous: pd.DataFrame = None):
+        """Write the partitions of `table_name` whose checksum differs from `previous`, each as one file.
+
+        Rows dated today may still change and are left to the next run. Returns the rows written and
+        the partitions written with their checksums.
+        """
+        today = date.today()
+        with data_inheritance(self.connection):
+            if not table_exists(self.connection, table_name):
+                return 0, pd.DataFrame()
+            changed = self.partitions(table_name, today)
+            if previous is not None and not previous.empty:
+                changed = changed.merge(previous, on=["symbol", "year"], how="left", suffixes=("", "_exported"))
+                changed = changed[changed["checksum"] != changed["checksum_exported"]].drop(columns="checksum_exported")
+            if changed.empty:
+                return 0, changed
+            self.connection.execute(
+                "create or replace temp table export_changed as"
+                " select unnest(?::varchar[]) as symbol, unnest(?::integer[]) as year;",
+                [changed["symbol"].tolist(), changed["year"].astype(int).tolist()],
+            )
+            try:
+                with metrics.timed("export", table_name):
+                    written = self.connection.execute(
+                        f"""
+                        copy (
+                            select t.*, year(t.date) as year
+                            from {table_name} t join export_changed c on t.symbol = c.symbol and year(t.date) = c.year
+                            where t.date < {_literal(today)}
+                        ) to {_literal(table_path(root, table_name))} (
+                            format parquet,
+                            compression zstd,
+                            partition_by (symbol, year),
+                            filename_pattern '{PARTITION_FILE}',
+                            overwrite_or_ignore
+                        );
+                        """
+                    ).fetchone()[0]
+            finally:
+                self.connection.execute("drop table if exists export_changed;")
+        return written, changed
+
+    def export(self, tables: list[str] = None, root: str = EXPORT_ROOT, full: bool = False) -> dict:
+        """Export the partitions of every table in `tables` that changed since they were last exported to `root`.
+
+        `full` writes every partition again. Returns the rows written per table.
+        """
+        exported, state = {}, []
+        for table_name in tables or EXPORT_TABLES:
+            try:
+                previous = None if full else self.exported(table_name, root)
+                rows, changed = self.export_table(table_name, root, previous)
+                exported[table_name] = rows
+                if not changed.empty:
+                    state.append(changed.assign(table_name=table_name, root=root))
+            except Exception as ex:
+                logger.error(f"failed to export {table_name} to {root}: {ex}")
+        if state:
+            frame = pd.concat(state, ignore_index=True).assign(exported_at=datetime.today())
+            self.sync_load_and_merge(frame, STATE_TABLE, ["table_name", "root", "symbol", "year"])
+        return exported
+
+
+def read_table(
+    table_name: str,
+    root: str = EXPORT_ROOT,
+    symbols: list[str] = None,
+    start=None,
+    end=None,
+    columns: list[str] = None,
+    connection=None,
+) -> pd.DataFrame:
+    """Read an exported table, scanning only the partitions of `symbols` and of the years from `start` to `end`.
+
+    The date range is pushed down to the Parquet row groups as well. `columns` limits the columns read.
+    """
+    connection = connection or duckdb.connect()
+    filters = []
+    if symbols:
+        filters.append(f"symbol in ({', '.join(_literal(symbol.upper()) for symbol in symbols)})")
+    if start is not None:
+        start = pd.Timestamp(start)
+        filters.append(f"year >= {start.year} and date >= {_literal(start)}")
+    if end is not None:
+        end = pd.Timestamp(end)
+        filters.append(f"year <= {end.year} and date <= {_literal(end)}")
+    select = ", ".join(f'"{column}"' for column in columns) if columns else "* exclude (year)"
+    where = f"where {' and '.join(filters)}" if filters else ""
+    path = _literal(f"{table_path(root, table_name)}/**/*.parquet")
+    return connection.execute(
+        f"select {select} from read_parquet({path}, hive_partitioning = true, hive_types = {HIVE_TYPES}) {where};"
+    ).fetchdf()
+
+
+def read_quotes(root: str = EXPORT_ROOT, symbols: list[str] = None, start=None, end=None, columns: list[str] = None):
+    """ """
+    return read_table("quote", root, symbols=symbols, start=start, end=end, columns=columns)
@@ -1,34 +1,61 @@
 from finance.core import get_tickers as gt
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import duckdb
 from vaultdb import VaultDB
+from finance.core import metrics
+from finance.core.write_buffer import BufferedMerge
 
 # Set up the logger
 import logging
 
 logger = logging.getLogger()
 
+# screener column: (unit to strip, arrow type)
+NUMERIC_COLUMNS = {
+    "lastsale": ("$", pa.float64()),
+    "netchange": (None, pa.float64()),
+    "pctchange": ("%", pa.float64()),
+    "marketCap": (None, pa.float64()),
+    "ipoyear": (None, pa.int64()),
+    "volume": (None, pa.int64()),
+}
 
-class Tickers(VaultDB):
+
+class Tickers(BufferedMerge, VaultDB):
 
     def extract(self) -> pd.DataFrame:
-        df = gt.get_tickers_dataframe()
+        with metrics.timed("extract", "tickers"):
+            df = gt.get_tickers_dataframe()
         logger.debug(df.head())
         return df
 
-    def transform(self, tickers_df: pd.DataFrame) -> pd.DataFrame:
-        tickers_df["lastsale"] = pd.to_numeric(tickers_df["lastsale"].str.replace("$", ""))
-        tickers_df["netchange"] = pd.to_numeric(tickers_df["netchange"])
-        tickers_df["pctchange"] = pd.to_numeric(tickers_df["pctchange"].str.replace("%", ""))
-        tickers_df["marketCap"] = pd.to_numeric(tickers_df["marketCap"])
-        tickers_df["ipoyear"] = pd.to_numeric(tickers_df["ipoyear"])
-        tickers_df["volume"] = pd.to_numeric(tickers_df["volume"])
-        return tickers_df
+    def transform(self, tickers_df: pd.DataFrame) -> pa.Table:
+        """Build a typed Arrow table, parsing the numeric screener columns with Arrow compute kernels."""
+        table = pa.Table.from_pandas(tickers_df, preserve_index=False)
+        for column, (unit, arrow_type) in NUMERIC_COLUMNS.items():
+            if column not in table.column_names:
+                continue
+            values = table[column]
+            if pa.types.is_string(values.type) or pa.types.is_large_string(values.type):
+                if unit:
+                    values = pc.replace_substring(values, unit, "")
+                values = pc.utf8_trim_whitespace(values)
+                # the screener sends empty strings for missing values
+                values = pc.if_else(pc.equal(values, ""), pa.scalar(None, values.type), values)
+                if pa.types.is_integer(arrow_type):
+                    values = pc.cast(values, pa.float64())
+            values = pc.cast(values, arrow_type)
+            table = table.set_column(table.column_names.index(column), column, values)
+        return table
 
     def load(self):
         tickers_df = self.extract()
-        tickers_df = self.transform(tickers_df)
-
+        with metrics.timed("transform", "tickers"):
+            tickers = self.transform(tickers_df)
+        # arrow backed columns are handed to the merge without converting them to numpy
+        tickers_df = tickers.to_pandas(types_mapper=pd.ArrowDtype)
         self.sync_load_and_merge(tickers_df, "tickers", ["exchange", "symbol"], "exchange")
 
 
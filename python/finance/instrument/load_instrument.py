@@ -1,8 +1,14 @@
-import requests_cache
+import contextvars
+import functools
 import yfinance as yf
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from vaultdb import VaultDB
+from finance.core.write_buffer import BufferedMerge
+from finance.core import fingerprint, metrics, sessions
+from finance.quotes import load_historical_quotes
+from finance.instrument import option_analytics
 
 # Set up the logger
 import logging
@@ -11,22 +17,77 @@ logger = logging.getLogger()
 
 yesterday = datetime.today() - timedelta(days=1)
 
+DEFAULT_FETCH_WORKERS = 8
 
-class InstrumentFinancial(VaultDB):
+
+def _reported(df: pd.DataFrame) -> pd.DataFrame:
+    df["Date Reported"] = datetime.today()
+    return df
+
+
+def _shares_full(ticker: yf.Ticker) -> pd.DataFrame:
+    shares_full = ticker.get_shares_full(start="1901-01-01", end=datetime.today().strftime("%Y-%m-%d"))
+    shares_full = shares_full.to_frame()
+    shares_full.reset_index(inplace=True)
+    shares_full = shares_full.rename(columns={0: "shares", "index": "Date"})
+    return shares_full.drop_duplicates(subset=["Date"])
+
+
+# Show future and historic earnings dates, returns at most next 4 quarters and last 8 quarters by default.
+# Note: If more are needed use msft.get_earnings_dates(limit=XX) with increased limit argument.
+def _earnings_dates(ticker: yf.Ticker) -> pd.DataFrame:
+    return ticker.earnings_dates.rename(columns={"Surprise(%)": "Surprise_Percent"})
+
+
+def _timed_fetch(table_name: str, fetch, ticker: yf.Ticker) -> pd.DataFrame:
+    with metrics.timed("extract", table_name):
+        return fetch(ticker)
+
+
+# (table name, fetch, primary keys, partition by, reset index), written in this order
+FUNDAMENTAL_TABLES = [
+    # holders
+    ("major_holders", lambda t: _reported(t.major_holders), [], "symbol", False),
+    ("institutional_holders", lambda t: t.institutional_holders, [], "symbol", False),
+    ("mutualfund_holders", lambda t: t.mutualfund_holders, [], "symbol", False),
+    ("insider_transactions", lambda t: t.insider_transactions, [], "symbol", False),
+    ("insider_purchases", lambda t: _reported(t.insider_purchases), [], "symbol", False),
+    # Partion this table no need of primary key
+    ("insider_roster_holders", lambda t: _reported(t.insider_roster_holders), [], "symbol", False),
+    # actions (dividends, splits, capital gains)
+    ("actions", lambda t: t.actions, ["symbol", "date"], None, True),
+    ("dividends", lambda t: t.dividends, ["symbol", "date"], None, True),
+    ("capital_gains", lambda t: t.capital_gains, ["symbol", "date"], None, True),  # only for mutual funds & etfs
+    ("splits", lambda t: t.splits, ["symbol", "date"], None, True),
+    # financials, see `Ticker.get_income_stmt()` for more options
+    ("income_statement", lambda t: t.income_stmt.transpose(), [], "symbol", True),
+    ("quarterly_income_statement", lambda t: t.quarterly_income_stmt.transpose(), [], "symbol", True),
+    ("balance_sheet", lambda t: t.balance_sheet.transpose(), [], "symbol", True),
+    ("quarterly_balance_sheet", lambda t: t.quarterly_balance_sheet.transpose(), [], "symbol", True),
+    ("cashflow", lambda t: t.cashflow.transpose(), [], "symbol", True),
+    ("quarterly_cashflow", lambda t: t.quarterly_cashflow.transpose(), [], "symbol", True),
+    # recommendations
+    ("recommendations", lambda t: _reported(t.recommendations), [], "symbol", False),
+    ("recommendations_summary", lambda t: _reported(t.recommendations_summary), [], "symbol", False),
+    ("upgrades_downgrades", lambda t: t.upgrades_downgrades, [], "symbol", False),
+    # share count
+    ("shares_outstanding", _shares_full, ["symbol", "date"], "symbol", False),
+    ("earnings_dates", _earnings_dates, ["symbol", "earnings_date"], None, True),
+]
+
+
+class InstrumentFinancial(BufferedMerge, VaultDB):
 
     symbol: str
 
-    def __init__(self, database_name: str, symbol: str, **kwargs) -> None:
+    def __init__(self, database_name: str, symbol: str = None, **kwargs) -> None:
         super().__init__(database_name, **kwargs)
         self.symbol = symbol
 
-    def extract(self, symbol: str) -> yf.Ticker:
-        session = requests_cache.CachedSession(
-            f"{self.database_name}.{self.symbol}.instruments.yfinance.cache",
-        )
-        session.headers["User-agent"] = "my-program/1.0"
-        ticker = yf.Ticker(self.symbol.upper(), session=session)
-        logger.debug(ticker.isin)
+    def extract(self, symbol: str = None) -> yf.Ticker:
+        ticker = yf.Ticker((symbol or self.symbol).upper(), session=sessions.get_session())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(ticker.isin)
         return ticker
 
     def transform_and_insert(
@@ -37,17 +98,31 @@ class InstrumentFinancial(VaultDB):
         primary_keys: list[str],
         partition_by: str = None,
         reset_index=True,
+        on_merged=None,
     ):
         if not df.empty:
-            if isinstance(df, pd.Series):
-                df = df.to_frame()
-            if symbol:
-                df["symbol"] = symbol.upper()
-            if reset_index:
-                df.reset_index(inplace=True)
-                if df.columns[0] == "index":
-                    df = df.rename(columns={"index": "Date"})
-            self.sync_load_and_merge(df, table_name, primary_keys, partition_by)
+            with metrics.timed("transform", table_name):
+                if isinstance(df, pd.Series):
+                    df = df.to_frame()
+                if symbol:
+                    df["symbol"] = symbol.upper()
+                if reset_index:
+                    df.reset_index(inplace=True)
+                    if df.columns[0] == "index":
+                        df = df.rename(columns={"index": "Date"})
+            self.sync_load_and_merge(df, table_name, primary_keys, partition_by, on_merged=on_merged)
+        elif on_merged:
+            # nothing to merge, the hash of the empty frame is stored right away
+            on_merged()
+
+    def store_fingerprint(self, symbol: str, table_name: str, digest: str):
+        """Record the content hash of the last load of `table_name`, once its rows were merged."""
+        self.sync_load_and_merge(
+            fingerprint.fingerprint_frame(symbol, {table_name: digest}),
+            fingerprint.FINGERPRINT_TABLE,
+            ["symbol", "table_name"],
+            owners=[symbol],
+        )
 
     def try_transform_and_insert(
         self, df, table_name: str, symbol: str, primary_keys: list[str], partition_by: str = None, reset_index=True
@@ -55,131 +130,75 @@ class InstrumentFinancial(VaultDB):
         """ """
         try:
             if isinstance(df, yf.Ticker):
-                df = getattr(df, table_name)
+                with metrics.timed("extract", table_name):
+                    df = getattr(df, table_name)
             self.transform_and_insert(df, table_name, symbol, primary_keys, partition_by, reset_index=reset_index)
         except Exception as ex:
             logger.error(ex)
 
-    def load(self, symbol: str):
-        ticker = self.extract()
-        # show holders
-        try:
-            major_holders = ticker.major_holders
-            major_holders["Date Reported"] = datetime.today()
-            self.transform_and_insert(major_holders, "major_holders", self.symbol, [], "symbol", reset_index=False)
-        except Exception as ex:
-            logger.error(ex)
-
-        self.try_transform_and_insert(ticker, "institutional_holders", self.symbol, [], "symbol", reset_index=False)
-        self.try_transform_and_insert(ticker, "mutualfund_holders", self.symbol, [], "symbol", reset_index=False)
-        self.try_transform_and_insert(ticker, "insider_transactions", self.symbol, [], "symbol", reset_index=False)
-
-        try:
-            insider_purchases = ticker.insider_purchases
-            insider_purchases["Date Reported"] = datetime.today()
-            self.try_transform_and_insert(
-                insider_purchases, "insider_purchases", self.symbol, [], "symbol", reset_index=False
-            )
-        except Exception as ex:
-            logger.error(ex)
-
-        try:
-            insider_roster_holders = ticker.insider_roster_holders
-            insider_roster_holders["Date Reported"] = datetime.today()
-            # Partion this table no need of primary key
-            self.try_transform_and_insert(
-                insider_roster_holders, "insider_roster_holders", self.symbol, [], "symbol", reset_index=False
-            )
-        except Exception as ex:
-            logger.error(ex)
-
-        # show actions (dividends, splits, capital gains)
-        self.try_transform_and_insert(ticker, "actions", self.symbol, ["symbol", "date"])
-        self.try_transform_and_insert(ticker, "dividends", self.symbol, ["symbol", "date"])
-        self.try_transform_and_insert(
-            ticker, "capital_gains", self.symbol, ["symbol", "date"]
-        )  # only for mutual funds & etfs
-        self.try_transform_and_insert(ticker, "splits", self.symbol, ["symbol", "date"])
-
-        # show financials:
-        # - income statement
-        # see `Ticker.get_income_stmt()` for more options
-        try:
-            self.try_transform_and_insert(ticker.income_stmt.transpose(), "income_statement", self.symbol, [], "symbol")
-        except Exception as ex:
-            logger.error(ex)
-
-        try:
-            self.try_transform_and_insert(
-                ticker.quarterly_income_stmt.transpose(), "quarterly_income_statement", self.symbol, [], "symbol"
-            )
-        except Exception as ex:
-            logger.error(ex)
-        # - balance sheet
-        try:
-            self.try_transform_and_insert(ticker.balance_sheet.transpose(), "balance_sheet", self.symbol, [], "symbol")
-        except Exception as ex:
-            logger.error(ex)
-        try:
-            self.try_transform_and_insert(
-                ticker.quarterly_balance_sheet.transpose(), "quarterly_balance_sheet", self.symbol, [], "symbol"
-            )
-        except Exception as ex:
-            logger.error(ex)
-        # - cash flow statement
-        try:
-            self.try_transform_and_insert(ticker.cashflow.transpose(), "cashflow", self.symbol, [], "symbol")
-        except Exception as ex:
-            logger.error(ex)
-        try:
-            self.try_transform_and_insert(
-                ticker.quarterly_cashflow.transpose(), "quarterly_cashflow", self.symbol, [], "symbol"
-            )
-        except Exception as ex:
-            logger.error(ex)
-
-        # show recommendations
-        try:
-            recommendations = ticker.recommendations
-            recommendations["Date Reported"] = datetime.today()
-            self.try_transform_and_insert(
-                recommendations, "recommendations", self.symbol, [], "symbol", reset_index=False
-            )
-        except Exception as ex:
-            logger.error(ex)
-
-        try:
-            recommendations_summary = ticker.recommendations_summary
-            recommendations_summary["Date Reported"] = datetime.today()
-            self.try_transform_and_insert(
-                recommendations_summary, "recommendations_summary", self.symbol, [], "symbol", reset_index=False
-            )
-        except Exception as ex:
-            logger.error(ex)
-
-        self.try_transform_and_insert(ticker, "upgrades_downgrades", self.symbol, [], "symbol", reset_index=False)
+    def load(self, symbol: str = None, max_workers: int = DEFAULT_FETCH_WORKERS, checkpoint=None) -> dict:
+        """Fetch every fundamentals table concurrently, then write them in declaration order.
 
-        # show share count
+        A failure to fetch or write one table is logged and does not affect the others. Tables whose
+        content hashes the same as on the last load are not merged again; a table's hash is only stored
+        once its rows were merged.
+        With a `checkpoint` tables it already holds for the symbol are skipped, and every table
+        written is marked as `symbol/table`. Returns the number of tables written and unchanged.
+        """
+        counts = {"written": 0, "unchanged": 0}
+        if symbol:
+            self.symbol = symbol
+        tables = [
+            table
+            for table in FUNDAMENTAL_TABLES
+            if checkpoint is None or not checkpoint.is_done(f"{self.symbol}/{table[0]}")
+        ]
+        if not tables:
+            return counts
         try:
-            shares_full = ticker.get_shares_full(start="1901-01-01", end=datetime.today().strftime("%Y-%m-%d"))
-            shares_full = shares_full.to_frame()
-            shares_full.reset_index(inplace=True)
-            shares_full = shares_full.rename(columns={0: "shares", "index": "Date"})
-            shares_full = shares_full.drop_duplicates(subset=["Date"])
-            self.try_transform_and_insert(
-                shares_full, "shares_outstanding", self.symbol, ["symbol", "date"], "symbol", reset_index=False
-            )
-        except Exception as ex:
-            logger.error(ex)
-
-        # Show future and historic earnings dates, returns at most next 4 quarters and last 8 quarters by default.
-        # Note: If more are needed use msft.get_earnings_dates(limit=XX) with increased limit argument.
-        try:
-            earnings_dates = ticker.earnings_dates
-            earnings_dates = earnings_dates.rename(columns={"Surprise(%)": "Surprise_Percent"})
-            self.try_transform_and_insert(earnings_dates, "earnings_dates", self.symbol, ["symbol", "earnings_date"])
+            previous = fingerprint.load_fingerprints(self.connection, self.symbol)
         except Exception as ex:
-            logger.error(ex)
+            logger.error(f"failed to read fingerprints of {self.symbol}: {ex}")
+            previous = {}
+        ticker = self.extract()
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"fetch-{self.symbol}") as executor:
+            # each fetch runs in a copy of this context so it keeps the metrics task label
+            fetches = [
+                (
+                    table,
+                    executor.submit(contextvars.copy_context().run, _timed_fetch, table, fetch, ticker),
+                    primary_keys,
+                    partition_by,
+                    reset_index,
+                )
+                for table, fetch, primary_keys, partition_by, reset_index in tables
+            ]
+            for table_name, fetch, primary_keys, partition_by, reset_index in fetches:
+                try:
+                    df = fetch.result()
+                    digest = fingerprint.fingerprint(df) if df is not None else None
+                    if digest is not None and previous.get(table_name) == digest:
+                        counts["unchanged"] += 1
+                        metrics.inc(metrics.UNCHANGED, table=table_name)
+                    else:
+                        on_merged = None
+                        if digest is not None:
+                            on_merged = functools.partial(self.store_fingerprint, self.symbol, table_name, digest)
+                        self.transform_and_insert(
+                            df,
+                            table_name,
+                            self.symbol,
+                            primary_keys,
+                            partition_by,
+                            reset_index=reset_index,
+                            on_merged=on_merged,
+                        )
+                        counts["written"] += 1
+                    if checkpoint is not None:
+                        checkpoint.mark(f"{self.symbol}/{table_name}")
+                except Exception as ex:
+                    logger.error(f"{self.symbol} {table_name}: {ex}")
+        return counts
 
     def load_news(self):
         """ """
@@ -189,43 +208,120 @@ class InstrumentFinancial(VaultDB):
         news["Date Reported"] = datetime.today()
         self.try_transform_and_insert(news, "news_links", self.symbol, [], "symbol", reset_index=False)
 
-    def load_options_and_quotes(self, period: str):
-        """ """
+    def load_options_and_quotes(self, period: str = None) -> int:
+        """Load every expiry's option chain; contract history is only fetched when `period` is given.
+
+        A failed expiry is logged and does not stop the others. Returns the number of expiries that
+        failed, 1 when the expiries could not be listed.
+        """
         try:
             ticker = self.extract()
-            # get option chain for specific expiration
-            for expiry_date in ticker.options:
-                opt = ticker.option_chain(expiry_date)
-                self.load_option_chain(opt.calls, expiry_date, "call", period)
-                self.load_option_chain(opt.puts, expiry_date, "put", period)
+            expiries = ticker.options
         except Exception as ex:
-            logger.error(ex)
+            logger.error(f"{self.symbol} options: {ex}")
+            return 1
+        errors = 0
+        # get option chain for specific expiration
+        for expiry_date in expiries:
+            try:
+                with metrics.timed("extract", "option_chain"):
+                    opt = ticker.option_chain(expiry_date)
+                options = pd.concat([opt.calls.assign(type="call"), opt.puts.assign(type="put")], ignore_index=True)
+                if not self.load_option_chain(options, expiry_date, option_quote_period=period):
+                    errors += 1
+            except Exception as ex:
+                logger.error(f"{self.symbol} options {expiry_date}: {ex}")
+                errors += 1
+        return errors
 
     def load_option_chain(
-        self, options: pd.DataFrame, expiry_date: str, option_type: str, option_quote_period: str = "1d"
-    ):
-        """ """
+        self, options: pd.DataFrame, expiry_date: str, option_type: str = None, option_quote_period: str = None
+    ) -> bool:
+        """Merge the contracts into `option_chain` and their latest trade into `quote`, once per frame.
+
+        When `option_quote_period` is set the contracts' price history is downloaded in batches as well.
+        Returns False when any of it failed.
+        """
         try:
-            contracts = options[["contractSymbol", "strike", "currency"]]
+            if option_type:
+                options = options.assign(type=option_type)
+            contracts = options[["contractSymbol", "strike", "currency", "type"]]
             contracts = contracts.rename(columns={"contractSymbol": "symbol"})
-            contracts["type"] = option_type
             contracts["underlying"] = self.symbol
             contracts["expiry_date"] = datetime.strptime(str(expiry_date), "%Y-%m-%d")
             self.sync_load_and_merge(contracts, "option_chain", ["symbol"])
-            from finance.quotes import load_historical_quotes
-
-            contract_price = options[["contractSymbol", "openInterest", "impliedVolatility"]]
-            for row in contract_price.itertuples(index=False):
-                load_historical_quotes.load(
-                    self.connection,
-                    self.database_name,
-                    symbol=row.contractSymbol,
-                    period=option_quote_period,
-                    openinterest=row.openInterest,
-                    impliedvolatility=row.impliedVolatility,
-                )
+
+            failed_chunks = 0
+            if option_quote_period:
+                failed_chunks = self.load_option_history(options["contractSymbol"].tolist(), option_quote_period)
+
+            # the chain already carries the last trade of every contract, write it without another request
+            quotes = pd.DataFrame(
+                {
+                    "Date": pd.to_datetime(options["lastTradeDate"], utc=True)
+                    .dt.tz_convert("America/New_York")
+                    .dt.normalize(),
+                    "Close": options["lastPrice"],
+                    "Volume": options["volume"].fillna(0),
+                    "symbol": options["contractSymbol"],
+                    "openinterest": options["openInterest"],
+                    "impliedvolatility": options["impliedVolatility"],
+                }
+            )
+            quotes = quotes.dropna(subset=["Date"]).drop_duplicates(subset=["symbol", "Date"], keep="last")
+            if not quotes.empty:
+                self.sync_load_and_merge(quotes, "quote", ["symbol", "date"], "symbol")
+            return not failed_chunks
         except Exception as ex:
             logger.error(ex)
+            return False
+
+    def load_option_history(
+        self, contract_symbols: list[str], period: str, chunk_size: int = load_historical_quotes.DEFAULT_CHUNK_SIZE
+    ) -> int:
+        """Download the price history of `contract_symbols` in chunks. Returns the number of chunks that failed."""
+        failed = 0
+        for chunk in load_historical_quotes.chunks(contract_symbols, chunk_size):
+            try:
+                history = load_historical_quotes.download_quotes(chunk, session=sessions.get_session(), period=period)
+                if history.empty:
+                    continue
+                history.reset_index(inplace=True)
+                self.sync_load_and_merge(history, "quote", ["symbol", "date"], "symbol")
+            except Exception as ex:
+                failed += 1
+                logger.error(f"failed to load option quotes for {chunk[0]}..{chunk[-1]}: {ex}")
+        return failed
+
+    def load_option_analytics(
+        self, underlyings: list[str], chunk_size: int = load_historical_quotes.DEFAULT_CHUNK_SIZE
+    ) -> int:
+        """Compute Greeks and the IV surface of the stored chains of `underlyings`.
+
+        Every chunk of underlyings is read with one query and valued in one vectorized pass.
+        Returns the number of contracts valued.
+        """
+        contracts = 0
+        for chunk in load_historical_quotes.chunks(list(underlyings), chunk_size):
+            try:
+                chain = option_analytics.load_chain(self.connection, chunk)
+                if chain.empty:
+                    continue
+                with metrics.timed("transform", option_analytics.GREEKS_TABLE):
+                    greeks = option_analytics.compute_greeks(chain)
+                    surface = option_analytics.compute_surface(chain)
+                self.sync_load_and_merge(greeks, option_analytics.GREEKS_TABLE, ["symbol", "date"], "underlying")
+                if not surface.empty:
+                    self.sync_load_and_merge(
+                        surface,
+                        option_analytics.SURFACE_TABLE,
+                        ["underlying", "expiry_date", "moneyness", "date"],
+                        "underlying",
+                    )
+                contracts += len(greeks)
+            except Exception as ex:
+                logger.error(f"failed to compute option analytics for {chunk[0]}..{chunk[-1]}: {ex}")
+        return contracts
 
 
 if __name__ == "__main__":
@@ -235,4 +331,5 @@ if __name__ == "__main__":
     # instr.connection.execute(f"DROP TABLE insider_purchases;")
     # instr.load()
     # instr.load_news()
-    instr.load_options_and_quotes(period="max")
+    instr.load_options_and_quotes()
+    # instr.load_options_and_quotes(period="max")
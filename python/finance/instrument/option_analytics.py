@@ -0,0 +1,170 @@
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from finance.core.database import data_inheritance, table_exists
+
+# Set up the logger
+import logging
+
+logger = logging.getLogger()
+
+GREEKS_TABLE = "option_greeks"
+SURFACE_TABLE = "iv_surface"
+RISK_FREE_RATE = float(os.getenv("finance_risk_free_rate", 0.04))
+# strike / spot points every expiry's smile is sampled at
+MONEYNESS = np.array([0.8, 0.9, 0.95, 1.0, 1.05, 1.1, 1.2])
+SECONDS_PER_YEAR = 365 * 24 * 60 * 60
+# contracts expire at the close, valuations are dated in exchange time
+EXCHANGE_TIMEZONE = "America/New_York"
+MARKET_CLOSE_HOUR = 16
+
+# every unexpired contract with its latest implied volatility and the latest close of its underlying
+_CHAIN_SQL = """
+with contracts as (
+    select symbol, underlying, type, strike, expiry_date
+    from option_chain
+    where underlying in (select unnest(?::varchar[])) and expiry_date >= current_date
+),
+contract_quotes as (
+    select symbol, arg_max(impliedvolatility, date) as implied_volatility, arg_max(close, date) as last_price,
+        max(date) as quote_date
+    from quote
+    where symbol in (select symbol from contracts) and impliedvolatility is not null
+    group by symbol
+),
+spots as (
+    select symbol as underlying, arg_max(close, date) as spot
+    from quote
+    where symbol in (select distinct underlying from contracts)
+    group by symbol
+)
+select c.*, q.implied_volatility, q.last_price, q.quote_date, s.spot
+from contracts c join contract_quotes q using (symbol) join spots s using (underlying);
+"""
+
+
+def _norm_cdf(x: np.ndarray) -> np.ndarray:
+    # Abramowitz & Stegun 7.1.26 for erf, absolute error below 1.5e-7
+    z = np.abs(x) / np.sqrt(2.0)
+    t = 1.0 / (1.0 + 0.3275911 * z)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    erf = 1.0 - poly * np.exp(-z * z)
+    return 0.5 * (1.0 + np.sign(x) * erf)
+
+
+def _norm_pdf(x: np.ndarray) -> np.ndarray:
+    return np.exp(-0.5 * x * x) / np.sqrt(2.0 * np.pi)
+
+
+def black_scholes(
+    spot: np.ndarray,
+    strike: np.ndarray,
+    years: np.ndarray,
+    volatility: np.ndarray,
+    is_call: np.ndarray,
+    rate: float = RISK_FREE_RATE,
+) -> dict:
+    """Black-Scholes price and Greeks for arrays of European contracts.
+
+    Vega and rho are per volatility or rate point, theta per calendar day. Contracts without time
+    or volatility left get NaN.
+    """
+    spot, strike, years, volatility = (np.asarray(a, dtype="float64") for a in (spot, strike, years, volatility))
+    is_call = np.asarray(is_call, dtype=bool)
+    valid = (years > 0) & (volatility > 0) & (spot > 0) & (strike > 0)
+    years = np.where(valid, years, np.nan)
+    volatility = np.where(valid, volatility, np.nan)
+
+    sqrt_years = np.sqrt(years)
+    d1 = (np.log(spot / strike) + (rate + 0.5 * volatility**2) * years) / (volatility * sqrt_years)
+    d2 = d1 - volatility * sqrt_years
+    pdf_d1 = _norm_pdf(d1)
+    discount = strike * np.exp(-rate * years)
+    sign = np.where(is_call, 1.0, -1.0)
+    cdf_d1 = _norm_cdf(sign * d1)
+    cdf_d2 = _norm_cdf(sign * d2)
+
+    return {
+        "theoretical_price": sign * (spot * cdf_d1 - discount * cdf_d2),
+        "delta": sign * cdf_d1,
+        "gamma": pdf_d1 / (spot * volatility * sqrt_years),
+        "vega": spot * pdf_d1 * sqrt_years / 100,
+        "theta": (-spot * pdf_d1 * volatility / (2 * sqrt_years) - sign * rate * discount * cdf_d2) / 365,
+        "rho": sign * discount * years * cdf_d2 / 100,
+    }
+
+
+def years_to_expiry(expiry_dates: pd.Series, now: datetime = None) -> np.ndarray:
+    """Years from `now` to the market close of each expiry date."""
+    now = now or datetime.now(timezone.utc)
+    expiries = pd.to_datetime(expiry_dates).dt.tz_localize(None).dt.normalize()
+    closes = (expiries + pd.Timedelta(hours=MARKET_CLOSE_HOUR)).dt.tz_localize(EXCHANGE_TIMEZONE)
+    return ((closes - pd.Timestamp(now)).dt.total_seconds() / SECONDS_PER_YEAR).to_numpy()
+
+
+def _valuation_date(now: datetime) -> pd.Timestamp:
+    return pd.Timestamp(now).tz_convert(EXCHANGE_TIMEZONE).normalize()
+
+
+def load_chain(connection, underlyings: list[str]) -> pd.DataFrame:
+    """Read the unexpired chains of `underlyings` with their stored implied volatility and spot."""
+    with data_inheritance(connection):
+        if not (table_exists(connection, "option_chain") and table_exists(connection, "quote")):
+            return pd.DataFrame()
+        return connection.execute(_CHAIN_SQL, [[symbol.upper() for symbol in underlyings]]).fetchdf()
+
+
+def compute_greeks(chain: pd.DataFrame, rate: float = RISK_FREE_RATE, now: datetime = None) -> pd.DataFrame:
+    """Greeks of every contract in `chain`, in one vectorized pass."""
+    now = now or datetime.now(timezone.utc)
+    years = years_to_expiry(chain["expiry_date"], now)
+    greeks = black_scholes(
+        chain["spot"].to_numpy(),
+        chain["strike"].to_numpy(),
+        years,
+        chain["implied_volatility"].to_numpy(),
+        (chain["type"] == "call").to_numpy(dtype=bool, na_value=False),
+        rate,
+    )
+    columns = ["symbol", "underlying", "type", "strike", "expiry_date", "spot", "implied_volatility", "last_price"]
+    return chain[columns].assign(date=_valuation_date(now), years_to_expiry=years, **greeks)
+
+
+def compute_surface(chain: pd.DataFrame, now: datetime = None) -> pd.DataFrame:
+    """Implied volatility of every underlying and expiry at the `MONEYNESS` points.
+
+    Each smile is read from out of the money contracts, puts below the spot and calls above it,
+    and interpolated linearly in strike / spot without extrapolating past the listed strikes.
+    """
+    now = now or datetime.now(timezone.utc)
+    moneyness = chain["strike"] / chain["spot"]
+    otm = np.where(
+        moneyness < 1.0,
+        (chain["type"] == "put").to_numpy(dtype=bool, na_value=False),
+        (chain["type"] == "call").to_numpy(dtype=bool, na_value=False),
+    )
+    smiles = chain.assign(moneyness=moneyness)[otm & (chain["implied_volatility"] > 0)]
+    smiles = smiles.sort_values(["underlying", "expiry_date", "moneyness"])
+
+    frames = []
+    for (underlying, expiry_date), smile in smiles.groupby(["underlying", "expiry_date"], sort=False):
+        points = smile["moneyness"].to_numpy()
+        iv = np.interp(MONEYNESS, points, smile["implied_volatility"].to_numpy(), left=np.nan, right=np.nan)
+        frames.append(
+            pd.DataFrame(
+                {
+                    "underlying": underlying,
+                    "expiry_date": expiry_date,
+                    "moneyness": MONEYNESS,
+                    "implied_volatility": iv,
+                }
+            )
+        )
+    if not frames:
+        return pd.DataFrame()
+    surface = pd.concat(frames, ignore_index=True)
+    surface["years_to_expiry"] = years_to_expiry(surface["expiry_date"], now)
+    surface["date"] = _valuation_date(now)
+    return surface
@@ -0,0 +1,99 @@
+import pandas as pd
+from finance.core.database import data_inheritance, table_exists
+
+# Set up the logger
+import logging
+
+logger = logging.getLogger()
+
+INDICATORS_TABLE = "indicators"
+SMA_WINDOWS = (20, 50, 200)
+VOLATILITY_WINDOW = 20
+VWAP_WINDOW = 20
+TRADING_DAYS = 252
+# calendar days read before the first recomputed bar, enough for 200 bars across holidays
+LOOKBACK_DAYS = 400
+
+
+def _window(bars: int) -> str:
+    return f"(partition by symbol order by date rows between {bars - 1} preceding and current row)"
+
+
+def _rolling(expression: str, bars: int, counted: str = "*") -> str:
+    # a window is only reported once it holds `bars` values
+    window = _window(bars)
+    return f"case when count({counted}) over {window} = {bars} then {expression} over {window} end"
+
+
+def indicators_query(incremental: bool) -> str:
+    """Window query over `quote` for the symbols bound to the first parameter.
+
+    Incremental queries start every symbol at its last stored indicator, or at the earliest changed
+    quote bound to the second parameter when that is older, reading `LOOKBACK_DAYS` before it so the
+    windows are complete; symbols without indicators get their full history.
+    """
+    if incremental:
+        starts = f"""
+    select r.symbol,
+        case when max(i.date) is null or r.changed is null then max(i.date)
+            else least(max(i.date), cast(r.changed as timestamptz)) end as since
+    from requested r left join {INDICATORS_TABLE} i on i.symbol = r.symbol
+    group by r.symbol, r.changed"""
+    else:
+        starts = """
+    select symbol, null as since from requested"""
+    columns = [f"{_rolling('avg(close)', bars)} as sma_{bars}" for bars in SMA_WINDOWS]
+    columns.append(
+        f"{_rolling('stddev_samp(log_return)', VOLATILITY_WINDOW, 'log_return')} * sqrt({TRADING_DAYS})"
+        f" as volatility_{VOLATILITY_WINDOW}"
+    )
+    columns.append(
+        f"{_rolling('sum(traded_value)', VWAP_WINDOW)} / nullif(sum(volume) over {_window(VWAP_WINDOW)}, 0)"
+        f" as vwap_{VWAP_WINDOW}"
+    )
+    column_list = ",\n        ".join(columns)
+    return f"""
+with requested as (
+    select unnest(?::varchar[]) as symbol, unnest(?::varchar[]) as changed
+),
+starts as ({starts}
+),
+bars as (
+    select q.symbol, q.date, q.close, q.high, q.low, q.volume, s.since
+    from quote q join starts s on q.symbol = s.symbol
+    where s.since is null or q.date >= s.since - interval {LOOKBACK_DAYS} day
+),
+returns as (
+    select *,
+        close / lag(close) over (partition by symbol order by date) - 1 as return_1d,
+        ln(close / lag(close) over (partition by symbol order by date)) as log_return,
+        (high + low + close) / 3 * volume as traded_value
+    from bars
+),
+windows as (
+    select symbol, date, since, return_1d, log_return,
+        {column_list}
+    from returns
+)
+select * exclude (since) from windows
+where since is null or date >= since
+order by symbol, date;
+"""
+
+
+def compute_indicators(
+    connection, symbols: list[str], full: bool = False, changed_since: dict = None
+) -> pd.DataFrame:
+    """Compute indicators inside duckdb for `symbols`, only from their last stored indicator unless `full`.
+
+    `changed_since` maps symbols to the earliest quote date a load rewrote, e.g. history adjusted for a
+    split or dividend; their indicators are recomputed from there.
+    """
+    symbols = [symbol.upper() for symbol in symbols]
+    changed_since = {symbol.upper(): since for symbol, since in (changed_since or {}).items()}
+    changed = [None if changed_since.get(symbol) is None else str(changed_since[symbol]) for symbol in symbols]
+    with data_inheritance(connection):
+        if not table_exists(connection, "quote"):
+            return pd.DataFrame()
+        incremental = not full and table_exists(connection, INDICATORS_TABLE)
+        return connection.execute(indicators_query(incremental), [symbols, changed]).fetchdf()
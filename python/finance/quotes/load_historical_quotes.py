@@ -1,32 +1,166 @@
-import requests_cache
+import contextvars
+import queue
+import threading
+from collections import Counter, defaultdict
+from datetime import date, timedelta
 import yfinance as yf
 import pandas as pd
 from vaultdb import VaultDB
+from finance.core.write_buffer import BufferedMerge
+from finance.core import metrics, sessions
+from finance.core.schema import apply_schema
+from finance.core.database import data_inheritance, table_exists
+from finance.quotes import indicators
 
 # Set up the logger
 import logging
 
 logger = logging.getLogger()
 
+DEFAULT_CHUNK_SIZE = 100
+INCREMENTAL = "incremental"
+PRICE_COLUMNS = ["Open", "High", "Low", "Close"]
+# `Ticker.history` dates bars in exchange time, downloaded bars are converted to match it
+QUOTE_TIMEZONE = "America/New_York"
 
-class Quotes(VaultDB):
+INTRADAY_TABLE = "quote_intraday"
+# interval: (days per request, days of history yahoo serves), windows are kept small so every
+# downloaded frame stays well below the memory budget
+INTRADAY_WINDOWS = {
+    "1m": (1, 29),
+    "2m": (2, 59),
+    "5m": (5, 59),
+    "15m": (15, 59),
+    "30m": (30, 59),
+    "60m": (60, 729),
+    "90m": (59, 59),
+    "1h": (60, 729),
+}
+# downloaded frames waiting to be written, the download thread blocks while the queue is full
+DEFAULT_STREAM_QUEUE = 2
+DEFAULT_STREAM_MEMORY = 128 * 1024 * 1024
+
+
+def chunks(symbols: list[str], chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Yield successive slices of at most `chunk_size` symbols."""
+    for i in range(0, len(symbols), chunk_size):
+        yield symbols[i : i + chunk_size]
+
+
+def windows(interval: str, start: date = None, end: date = None) -> list[tuple[date, date]]:
+    """Split `start` to `end` into the request windows yahoo serves for `interval`."""
+    if interval not in INTRADAY_WINDOWS:
+        raise ValueError(f"Invalid interval {interval} allowed values are {', '.join(INTRADAY_WINDOWS)}.")
+    window_days, history_days = INTRADAY_WINDOWS[interval]
+    end = end or date.today() + timedelta(days=1)
+    start = max(start or date.min, end - timedelta(days=history_days))
+    spans = []
+    while start < end:
+        spans.append((start, min(start + timedelta(days=window_days), end)))
+        start = spans[-1][1]
+    return spans
+
+
+def download_quotes(symbols: list[str], session=None, failed: list = None, **download_args) -> pd.DataFrame:
+    """Download history for several symbols in one call, stacked by symbol.
+
+    `yf.download` still sends one request per symbol, from its own threads, through the shared
+    session and its rate limiter. `download_args` are passed to `yf.download` (period, start, end,
+    interval...). The result has the same columns and index timezone as `Ticker.history` plus a
+    `symbol` column.
+
+    A symbol yahoo returned an error or no bars for is logged and appended to `failed`, as passed in.
+    """
+    requested = {symbol.upper(): symbol for symbol in symbols}
+    symbols = list(requested)
+    data = yf.download(
+        tickers=symbols,
+        group_by="ticker",
+        auto_adjust=True,
+        actions=True,
+        threads=True,
+        progress=False,
+        session=session,
+        **download_args,
+    )
+    # yf.download keeps the columns of a symbol it failed to download, filled with NaN
+    errors = getattr(yf.shared, "_ERRORS", None) or {}
+
+    def fail(symbol: str, reason: str = None):
+        if reason is None:
+            logger.warning(f"no quotes returned for {symbol}")
+        else:
+            logger.error(f"failed to download quotes for {symbol}: {reason}")
+        if failed is not None:
+            failed.append(requested[symbol])
+
+    if data.empty:
+        for symbol in symbols:
+            fail(symbol, errors.get(symbol))
+        return pd.DataFrame()
+    if not isinstance(data.columns, pd.MultiIndex):
+        data = pd.concat({symbols[0]: data}, axis=1)
+
+    frames = []
+    available = set(data.columns.get_level_values(0))
+    for symbol in symbols:
+        if symbol in errors or symbol not in available:
+            fail(symbol, errors.get(symbol))
+            continue
+        history = data[symbol].dropna(how="all", subset=[c for c in PRICE_COLUMNS if c in data[symbol].columns])
+        if history.empty:
+            fail(symbol)
+            continue
+        history = history.copy()
+        # daily bars come back without a timezone, intraday ones in the exchange timezone
+        if history.index.tz is None:
+            history.index = history.index.tz_localize(QUOTE_TIMEZONE)
+        else:
+            history.index = history.index.tz_convert(QUOTE_TIMEZONE)
+        history["symbol"] = symbol
+        frames.append(apply_schema(history, "quote"))
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames)
+
+
+class Quotes(BufferedMerge, VaultDB):
+
+    # earliest bar merged per symbol since its indicators were last computed
+    changed_since: dict = None
 
     def extract(self, symbol: str, period: str = "1d") -> pd.DataFrame:
         """ """
-        session = requests_cache.CachedSession(
-            f"{self.database_name}.{symbol}.quotes.yfinance.cache",
-        )
-        session.headers["User-agent"] = "my-program/1.0"
-        ticker = yf.Ticker(symbol.upper(), session=session)
-        hist = ticker.history(period=period)
+        with metrics.timed("extract", "quote"):
+            ticker = yf.Ticker(symbol.upper(), session=sessions.get_session())
+            hist = ticker.history(period=period)
         return hist
 
+    def extract_batch(self, symbols: list[str], failed: list = None, **download_args) -> pd.DataFrame:
+        """ """
+        with metrics.timed("extract", "quote"):
+            return download_quotes(symbols, session=sessions.get_session(), failed=failed, **download_args)
+
     def transform_and_insert(self, df: pd.DataFrame, table_name: str) -> yf.Ticker:
         """ """
-        df.reset_index(inplace=True)
+        with metrics.timed("transform", table_name):
+            df.reset_index(inplace=True)
         self.sync_load_and_merge(df, table_name, ["symbol", "date"], "symbol")
+        if table_name == "quote":
+            self._track_changes(df)
         return df
 
+    def _track_changes(self, df: pd.DataFrame):
+        # a reload may rewrite old bars, e.g. history adjusted for a split, their indicators are stale
+        columns = {str(column).lower(): column for column in df.columns}
+        if df.empty or "date" not in columns or "symbol" not in columns:
+            return
+        if self.changed_since is None:
+            self.changed_since = {}
+        for symbol, earliest in df.groupby(columns["symbol"])[columns["date"]].min().items():
+            current = self.changed_since.get(symbol)
+            self.changed_since[symbol] = earliest if current is None else min(current, earliest)
+
     def load(self, symbol: str, period: str = "1d", **additionalvalues):
         """ """
         history = self.extract(symbol, period=period)
@@ -35,6 +169,231 @@ class Quotes(VaultDB):
             history[k] = v
         self.transform_and_insert(history, "quote")
 
+    def watermarks(self, symbols: list[str] = None) -> dict:
+        """Return the last stored quote date per symbol, read with one grouped query."""
+        with data_inheritance(self.connection):
+            if not table_exists(self.connection, "quote"):
+                return {}
+            last_dates = self.connection.execute(
+                "select symbol, cast(max(date) as date) as last_date from quote group by symbol;"
+            ).fetchdf()
+        last_dates = dict(zip(last_dates["symbol"], last_dates["last_date"]))
+        if symbols is not None:
+            wanted = {symbol.upper() for symbol in symbols}
+            last_dates = {symbol: last for symbol, last in last_dates.items() if symbol in wanted}
+        return last_dates
+
+    def load_incremental(
+        self,
+        symbols: list[str],
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        initial_period: str = "max",
+        on_chunk=None,
+    ) -> int:
+        """Fetch the bars from each symbol's watermark on and merge them.
+
+        The bar at the watermark is fetched again: it may have been stored mid-session and the merge
+        replaces it with the final one. Symbols with the same gap are downloaded together. Symbols
+        without any stored quote are loaded with `initial_period`. `on_chunk(symbols, rows, failed)` is
+        called with the symbols of each chunk, up to date symbols included. Returns the number of rows
+        written to `quote`.
+        """
+        last_dates = self.watermarks(symbols)
+        end = date.today() + timedelta(days=1)
+        gaps = defaultdict(list)
+        skipped = []
+        for symbol in symbols:
+            last = last_dates.get(symbol.upper())
+            start = None if last is None else pd.Timestamp(last).date()
+            if start is not None and start >= end:
+                skipped.append(symbol)
+                continue
+            gaps[start].append(symbol)
+
+        rows = 0
+        for start, gap_symbols in sorted(gaps.items(), key=lambda gap: (gap[0] is not None, gap[0])):
+            download_args = {"period": initial_period} if start is None else {"start": start, "end": end}
+            for chunk in chunks(gap_symbols, chunk_size):
+                chunk_rows, failed = 0, []
+                try:
+                    history = self.extract_batch(chunk, failed=failed, **download_args)
+                    if start is not None and not history.empty:
+                        # yahoo may return bars before the start, keep the last stored bar and what is new
+                        bar_dates = history.index.tz_localize(None) if history.index.tz else history.index
+                        history = history[bar_dates >= pd.Timestamp(start)]
+                    if not history.empty:
+                        self.transform_and_insert(history, "quote")
+                        chunk_rows = len(history)
+                except Exception as ex:
+                    failed = list(chunk)
+                    logger.error(f"failed to load quotes for {chunk[0]}..{chunk[-1]}: {ex}")
+                rows += chunk_rows
+                if on_chunk:
+                    on_chunk(chunk, chunk_rows, failed)
+        if on_chunk and skipped:
+            on_chunk(skipped, 0, [])
+        return rows
+
+    def load_batch(
+        self,
+        symbols: list[str],
+        period: str = "1d",
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        on_chunk=None,
+        **additionalvalues,
+    ) -> int:
+        """Load quotes for many symbols with one download and one merge per chunk.
+
+        `on_chunk(symbols, rows, failed)` is called with the symbols of each chunk. Returns the number
+        of rows written to `quote`.
+        """
+        rows = 0
+        for chunk in chunks(list(symbols), chunk_size):
+            chunk_rows, failed = 0, []
+            try:
+                history = self.extract_batch(chunk, failed=failed, period=period)
+                if not history.empty:
+                    for k, v in additionalvalues.items():
+                        history[k] = v
+                    self.transform_and_insert(history, "quote")
+                    chunk_rows = len(history)
+            except Exception as ex:
+                failed = list(chunk)
+                logger.error(f"failed to load quotes for {chunk[0]}..{chunk[-1]}: {ex}")
+            rows += chunk_rows
+            if on_chunk:
+                on_chunk(chunk, chunk_rows, failed)
+        return rows
+
+    def load_indicators(self, symbols: list[str], chunk_size: int = DEFAULT_CHUNK_SIZE, full: bool = False) -> int:
+        """Recompute the indicators affected by newly merged quotes and merge them into `indicators`.
+
+        Unless `full` is set, only bars from each symbol's last stored indicator on are recomputed, or
+        from the earliest bar this loader merged for it when that is older. Returns the number of rows written.
+        """
+        rows = 0
+        changed_since = self.changed_since or {}
+        for chunk in chunks(list(symbols), chunk_size):
+            try:
+                with metrics.timed("transform", indicators.INDICATORS_TABLE):
+                    df = indicators.compute_indicators(
+                        self.connection,
+                        chunk,
+                        full=full,
+                        changed_since={symbol: changed_since.get(symbol.upper()) for symbol in chunk},
+                    )
+                if not df.empty:
+                    self.sync_load_and_merge(df, indicators.INDICATORS_TABLE, ["symbol", "date"], "symbol")
+                    rows += len(df)
+                for symbol in chunk:
+                    changed_since.pop(symbol.upper(), None)
+            except Exception as ex:
+                logger.error(f"failed to compute indicators for {chunk[0]}..{chunk[-1]}: {ex}")
+        return rows
+
+    def stream(
+        self,
+        symbols: list[str],
+        interval: str,
+        start: date = None,
+        end: date = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_pending: int = DEFAULT_STREAM_QUEUE,
+    ):
+        """Yield `(symbols, window start, window end, bars, failed)` for every chunk and request window.
+
+        Bars are downloaded by a background thread at most `max_pending` frames ahead of the consumer,
+        so a slow writer holds the download back. `bars` is None when the download failed, `failed`
+        lists the symbols without bars in the window.
+        """
+        spans = windows(interval, start, end)
+        pending = queue.Queue(maxsize=max_pending)
+        stop = threading.Event()
+        done = object()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    pending.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for chunk in chunks(list(symbols), chunk_size):
+                    for span_start, span_end in spans:
+                        failed = []
+                        try:
+                            bars = self.extract_batch(
+                                chunk, failed=failed, start=span_start, end=span_end, interval=interval
+                            )
+                            bars.index.name = "Date"
+                        except Exception as ex:
+                            logger.error(f"failed to download {interval} bars for {chunk[0]}..{chunk[-1]}: {ex}")
+                            bars, failed = None, list(chunk)
+                        if not put((chunk, span_start, span_end, bars, failed)):
+                            return
+            finally:
+                put(done)
+
+        # the thread runs in a copy of this context so it keeps the metrics task label
+        producer = threading.Thread(
+            target=contextvars.copy_context().run, args=(produce,), name=f"stream-{interval}", daemon=True
+        )
+        producer.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is done:
+                    break
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+
+    def load_stream(
+        self,
+        symbols: list[str],
+        interval: str = "5m",
+        start: date = None,
+        end: date = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        memory_budget: int = DEFAULT_STREAM_MEMORY,
+        on_chunk=None,
+    ) -> int:
+        """Write intraday bars to `quote_intraday` window by window as they are downloaded.
+
+        Half of `memory_budget` bounds the write buffer, the rest covers the frames in flight.
+        `on_chunk(symbols, rows, failed)` is called once all windows of a chunk are written. A symbol
+        failed when a window of it could not be downloaded or none of its windows returned bars, since
+        windows without a trading session are empty for every symbol. Returns the number of rows written.
+        """
+        spans = windows(interval, start, end)
+        if not spans:
+            return 0
+        last_end = spans[-1][1]
+        rows, chunk_rows, errored, empty = 0, 0, set(), Counter()
+        with self.buffered(max_bytes=memory_budget // 2):
+            for chunk, _, span_end, bars, failed in self.stream(symbols, interval, start, end, chunk_size):
+                empty.update(failed)
+                if bars is None:
+                    errored.update(chunk)
+                elif not bars.empty:
+                    bars["interval"] = interval
+                    with metrics.timed("transform", INTRADAY_TABLE):
+                        bars.reset_index(inplace=True)
+                    self.sync_load_and_merge(bars, INTRADAY_TABLE, ["symbol", "date", "interval"], "symbol")
+                    chunk_rows += len(bars)
+                if span_end >= last_end:
+                    rows += chunk_rows
+                    if on_chunk:
+                        failed = [s for s in chunk if s in errored or empty[s] == len(spans)]
+                        on_chunk(chunk, chunk_rows, failed)
+                    chunk_rows, errored, empty = 0, set(), Counter()
+        return rows
+
 
 if __name__ == "__main__":
     import os
@@ -1,4 +1,10 @@
 # Imports
+import time
+
+_cold_start = time.perf_counter()
+
+import base64
+import json
 import logging
 import os
 import duckdb
@@ -8,13 +14,199 @@ import logging
 
 from vaultdb import auth, commitlog_directory
 
+# imported once per container so warm invocations skip it
+from finance.core.database import data_inheritance
+from finance.instrument import all_tickers_load, load_instrument
+from finance.quotes import load_historical_quotes
+
 logger = logging.getLogger()
 
+_import_seconds = time.perf_counter() - _cold_start
+_warm = False
+# connections stay open between warm invocations, keyed by (catalog, role)
+_connections = {}
+
+# seconds spent loading per invocation, the rest of the 120 s timeout is left for the push
+DEFAULT_TIME_BUDGET = 90
+PUSH_RESERVE_SECONDS = 20
+# seconds of the time budget left for the final flush of the write buffer
+FLUSH_RESERVE_SECONDS = 10
+
+
+def _connect(catalog: str, role: str):
+    key = (catalog, role)
+    if key not in _connections:
+        _connections[key] = duckdb.connect(f"{commitlog_directory}/{catalog}.db", True, role=role)
+    return _connections[key]
+
+
+def _disconnect(catalog: str, role: str):
+    connection = _connections.pop((catalog, role), None)
+    if connection:
+        try:
+            connection.close()
+        except Exception as ex:
+            logger.error(ex)
+
+
+def _loader(loader_class, catalog: str, connection, *args):
+    loader = loader_class(catalog, *args)
+    loader.connection = connection
+    return loader
+
+
+def _time_budget(event: dict, context) -> float:
+    budget = float(event.get("time_budget", DEFAULT_TIME_BUDGET))
+    remaining = getattr(context, "get_remaining_time_in_millis", None)
+    if remaining:
+        budget = min(budget, remaining() / 1000 - PUSH_RESERVE_SECONDS)
+    return max(0.0, budget - FLUSH_RESERVE_SECONDS)
+
+
+def encode_continuation(last_symbol: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"after": last_symbol}).encode()).decode()
+
+
+def decode_continuation(token: str) -> str:
+    return json.loads(base64.urlsafe_b64decode(token.encode()))["after"] if token else None
+
+
+def _symbols(event: dict, connection) -> list[str]:
+    """Symbols requested by `tickers`, `symbol_prefix` or `ticker`, in order, after the continuation token."""
+    if "tickers" in event:
+        tickers = event["tickers"]
+        symbols = sorted({symbol.upper() for symbol in ([tickers] if isinstance(tickers, str) else tickers)})
+    elif "symbol_prefix" in event:
+        with data_inheritance(connection):
+            symbols = connection.execute(
+                "select distinct symbol from tickers where symbol like ? order by symbol;",
+                [f"{event['symbol_prefix'].upper()}%"],
+            ).fetchdf()["symbol"].tolist()
+    else:
+        symbols = [event["ticker"].upper()]
+    after = decode_continuation(event.get("continuation"))
+    return [symbol for symbol in symbols if after is None or symbol > after]
+
+
+def _load_within(batches: list[list[str]], load, budget: float) -> tuple[list[str], list[str]]:
+    """Call `load` for each batch while the next one is expected to fit in `budget` seconds.
+
+    `load` returns the symbols of its batch that failed. Loading stops after a failed batch, since
+    the continuation retries from there, unless every symbol before it failed as well.
+    Returns the symbols that were processed and those that failed.
+    """
+    started = time.perf_counter()
+    processed, failed = [], []
+    for batch in batches:
+        elapsed = time.perf_counter() - started
+        if processed and elapsed + elapsed / len(processed) * len(batch) > budget:
+            break
+        try:
+            batch_failed = load(batch)
+        except Exception as ex:
+            logger.error(f"failed to load {batch[0]}..{batch[-1]}: {ex}")
+            batch_failed = batch
+        processed.extend(batch)
+        failed.extend(batch_failed)
+        if batch_failed and len(failed) < len(processed):
+            break
+    return processed, failed
+
+
+def _resume_before_failure(processed: list[str], failed: set) -> list[str]:
+    """Cut `processed` at its first failed symbol so the continuation loads it again.
+
+    Failed symbols at the start are kept, a symbol that always fails would stall the continuation otherwise.
+    """
+    leading = 0
+    while leading < len(processed) and processed[leading] in failed:
+        leading += 1
+    for i in range(leading, len(processed)):
+        if processed[i] in failed:
+            return processed[:i]
+    return processed
+
+
+def _load(payload: str, event: dict, context, catalog: str, connection, write_buffers: list) -> dict:
+    """Run the load requested by `payload` and return the rows written and where to continue.
+
+    The write buffer is appended to `write_buffers` before loading starts, so the caller sees what
+    was flushed even when the load raises.
+    """
+    symbols = None
+    if payload == "LOAD_TICKERS":
+        loader = _loader(all_tickers_load.Tickers, catalog, connection)
+        work = loader.load
+    elif payload == "LOAD_INSTRUMENTS":
+        symbols = _symbols(event, connection)
+        logger.debug(f"tickers: {len(symbols)}")
+        loader = _loader(load_instrument.InstrumentFinancial, catalog, connection)
+
+        def load_instruments(batch: list[str]) -> list[str]:
+            loader.load(batch[0])
+            return []
+
+        work = lambda: _load_within([[symbol] for symbol in symbols], load_instruments, _time_budget(event, context))
+    elif payload == "LOAD_QUOTES":
+        symbols = _symbols(event, connection)
+        period = event["period"] if "period" in event else "1d"
+        chunk_size = int(event.get("chunk_size", load_historical_quotes.DEFAULT_CHUNK_SIZE))
+        logger.debug(f"tickers: {len(symbols)} period: {period}")
+        loader = _loader(load_historical_quotes.Quotes, catalog, connection)
+
+        def load_quotes(batch: list[str]) -> list[str]:
+            failed = []
+            loader.load_batch(
+                batch,
+                period=period,
+                chunk_size=chunk_size,
+                on_chunk=lambda chunk, rows, chunk_failed: failed.extend(chunk_failed),
+            )
+            return failed
+
+        work = lambda: _load_within(
+            list(load_historical_quotes.chunks(symbols, chunk_size)), load_quotes, _time_budget(event, context)
+        )
+    else:
+        raise ValueError(
+            f"Invalid Payload {payload} allowed values are LOAD_TICKERS, LOAD_INSTRUMENTS, LOAD_QUOTES."
+        )
+
+    with loader.buffered() as write_buffer:
+        write_buffers.append(write_buffer)
+        loaded = work()
+
+    result = {"rows": write_buffer.stats().get("rows", 0)}
+    if symbols is not None:
+        processed, failed = loaded
+        # symbols whose rows failed to merge in the final flush count as failed too
+        failed = set(failed) | write_buffer.failed_owners()
+        processed = _resume_before_failure(processed, failed)
+        result["failed"] = sorted(failed)
+        result["processed"] = len(processed)
+        result["remaining"] = len(symbols) - len(processed)
+        if not result["remaining"]:
+            result["continuation"] = None
+        elif processed:
+            result["continuation"] = encode_continuation(processed[-1])
+        else:
+            result["continuation"] = event.get("continuation") or encode_continuation("")
+    return result
+
 
 def lambda_handler(event, context):
+    global _warm
     logger.info(f"event: {event}!")
+    started = time.perf_counter()
+    timing = {"cold": not _warm}
+    if not _warm:
+        timing["import_seconds"] = round(_import_seconds, 3)
+    _warm = True
+
     connection = None
     catalog = None
+    preferred_role = None
+    write_buffers = []
     try:
         preferred_role = auth.GetAuthorizedRole(event["token"])
         logger.debug(f"role: {preferred_role}")
@@ -26,54 +218,37 @@ def lambda_handler(event, context):
 
         test_db_path = f"{commitlog_directory}/{catalog}.db"
         if os.path.isfile(test_db_path):
-            connection = duckdb.connect(f"{commitlog_directory}/{catalog}.db", True, role=preferred_role)
-
-            if payload.trim().upper() == "LOAD_TICKERS":
-                from finance.instrument import all_tickers_load
-
-                all_tickers_load.load(connection, catalog)
-                return {
-                    "result": "Success",
-                    "data": {"result": "finance ticker load ran successfully."},
-                }
-            elif payload.trim().upper() == "LOAD_INSTRUMENTS":
-                ticker = event["ticker"]
-                logger.debug(f"ticker: {ticker}")
-                from finance.instrument import load_instrument
-
-                load_instrument.load(connection, catalog, ticker)
-                return {
-                    "result": "Success",
-                    "data": {"result": "finance ticker load ran successfully."},
-                }
-            elif payload.trim().upper() == "LOAD_QUOTES":
-                ticker = event["ticker"]
-                logger.debug(f"ticker: {ticker}")
-                period = event["period"] if "period" in event else "1d"
-                logger.debug(f"ticker: {ticker}")
-                from finance.quotes import load_historical_quotes
-
-                load_historical_quotes.load(connection, catalog, ticker, period)
-                return {
-                    "result": "Success",
-                    "data": {"result": "finance ticker load ran successfully."},
-                }
-            else:
-                return {
-                    "result": "Error",
-                    "message": f"Invalid Payload {payload.trim().upper()} allowed values are LOAD_TICKERS, LOAD_INSTRUMENTS, LOAD_QUOTES.",
-                }
+            connection = _connect(catalog, preferred_role)
+            timing["setup_seconds"] = round(time.perf_counter() - started, 3)
+
+            loading = time.perf_counter()
+            loaded = _load(payload.strip().upper(), event, context, catalog, connection, write_buffers)
+            timing["load_seconds"] = round(time.perf_counter() - loading, 3)
+            return {
+                "result": "Success",
+                "data": {"result": "finance ticker load ran successfully.", **loaded},
+                "timing": timing,
+            }
 
         return {"result": "Error", "message": f"Catalog {catalog} does not exist."}
 
     except Exception as ex:
         logger.error(ex)
-        return {"result": "Error", "message": str(ex)}
+        return {"result": "Error", "message": str(ex), "timing": timing}
     finally:
         if connection:
-            connection.execute(f"PUSH DATABASE {catalog};")
-            connection.execute(f"TRUNCATE DATABASE {catalog};")
-            connection.close()
+            try:
+                # nothing to push when the load did not write anything, also counts flushes of a load that raised
+                if any(write_buffer.stats().get("flushes", 0) for write_buffer in write_buffers):
+                    pushing = time.perf_counter()
+                    connection.execute(f"PUSH DATABASE {catalog};")
+                    connection.execute(f"TRUNCATE DATABASE {catalog};")
+                    timing["push_seconds"] = round(time.perf_counter() - pushing, 3)
+            except Exception as ex:
+                logger.error(ex)
+                _disconnect(catalog, preferred_role)
+        timing["total_seconds"] = round(time.perf_counter() - started, 3)
+        logger.info(f"timing: {timing}")
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import os
+import socket
 import time
 import vaultdb
 import shutil
@@ -13,81 +14,430 @@ from vaultdb.compute import App
 vaultdb_user = os.getenv("vaultdb_user")
 vaultdb_password = os.getenv("vaultdb_password")
 
+from celery import chord
+from celery.schedules import crontab
+from celery.signals import task_postrun, task_prerun
+from finance.core import broker, checkpoint, metrics, planning, progress, sessions
+from finance.export import parquet
 from finance.instrument import all_tickers_load, load_instrument
 from finance.quotes import load_historical_quotes
 
 WAIT_TIME = 20
+# completed items a shard collects before it flushes its writes and saves them to the checkpoint
+CHECKPOINT_ITEMS = 500
 
 
-@App.task()
-def load_all_tickers(database_name: str = "finance"):
+@task_prerun.connect
+def _label_metrics(task=None, **kwargs):
+    metrics.set_task(task.name if task else "")
+
+
+@task_postrun.connect
+def _publish_metrics(**kwargs):
+    process_key = f"{socket.gethostname()}:{os.getpid()}"
+    metrics.publish(broker.get_redis(), process_key)
+    sessions.publish_stats(broker.get_redis(), process_key)
+
+
+def _progress(progress_id: str) -> progress.ProgressReporter:
+    return progress.ProgressReporter(progress_id, broker.get_redis())
+
+
+def _checkpoint(run_id: str) -> checkpoint.Checkpoint:
+    # shards started without a run only keep their checkpoint in memory
+    return checkpoint.Checkpoint(run_id, broker.get_redis() if run_id else None)
+
+
+@App.task(bind=True)
+def load_all_tickers(self, database_name: str = "finance"):
+    reporter = _progress(self.request.id)
+    reporter.start(total=1)
     app = all_tickers_load.Tickers(database_name)
     connection = app.clone(vaultdb_user, vaultdb_password)
     connection.execute(f"TRUNCATE DATABASE {database_name};")
-    app.load()
+    with app.buffered() as write_buffer:
+        app.load()
+    rows = write_buffer.stats().get("rows", 0)
+    reporter.advance(symbols=1, rows=rows)
+    reporter.finish(rows=rows)
 
 
-@App.task()
-def load_quotes(database_name: str = "finance", period: str = "1d", symbol_prefix: str = None):
-    app = load_historical_quotes.Quotes(database_name)
-    connection = app.clone(vaultdb_user, vaultdb_password)
+def _symbols(connection, symbol_prefix: str = None, columns: str = "exchange, symbol"):
     connection.execute(f"PRAGMA enable_data_inheritance;;")
     if symbol_prefix:
         tickers = connection.execute(
-            f"select exchange, symbol from tickers where symbol like '{symbol_prefix}%';"
+            f"select {columns} from tickers where symbol like ? order by symbol;", [f"{symbol_prefix}%"]
         ).fetchdf()
     else:
-        tickers = connection.execute(f"select exchange, symbol from tickers;").fetchdf()
+        tickers = connection.execute(f"select {columns} from tickers order by symbol;").fetchdf()
     connection.execute(f"PRAGMA disable_data_inheritance;")
-    for row in tickers.itertuples(index=False):
-        try:
-            app.load(row.symbol, period=period)
-        except Exception as ex:
-            logger.error(ex)
+    return tickers
+
+
+def _fan_out(
+    task, shard_task, shards: list[list[str]], *args, run_id: str = None, options: dict = None, **kwargs
+):
+    # shards report progress under the id of the task the client started
+    progress_id = task.request.id
+    options = options or {}
+    _progress(progress_id).start(total=sum(len(shard) for shard in shards))
+    header = [
+        shard_task.s(shard, *args, progress_id=progress_id, run_id=run_id, **kwargs).set(**options)
+        for shard in shards
+    ]
+    job = chord(header)(summarize_shards.s(progress_id=progress_id).set(**options))
+    return {"shards": len(shards), "summary_task_id": job.id, "run_id": run_id}
+
+
+def _chunk_done(
+    reporter: progress.ProgressReporter, completed: checkpoint.Checkpoint, write_buffer, failed_symbols: list[str]
+):
+    """`on_chunk` callback advancing progress, checkpointing the symbols of a chunk that did not fail and
+    collecting the others in `failed_symbols`."""
+
+    def on_chunk(chunk: list[str], rows: int, failed: list[str]):
+        reporter.advance(symbols=len(chunk), rows=rows, errors=len(failed))
+        failed_symbols.extend(failed)
+        failed = set(failed)
+        completed.mark(*[symbol for symbol in chunk if symbol not in failed])
+        completed.save(write_buffer, min_pending=CHECKPOINT_ITEMS)
+
+    return on_chunk
+
+
+def _advance(
+    reporter: progress.ProgressReporter, write_buffer, rows_before: int, errors: int = 0, symbols: int = 1
+) -> int:
+    # rows only count once flushed, a shard reports its final flush with symbols=0
+    rows = write_buffer.stats().get("rows", 0)
+    reporter.advance(symbols=symbols, rows=rows - rows_before, errors=errors)
+    return rows
 
 
 @App.task()
-def load_instrument_details(database_name: str = "finance"):
+def summarize_shards(results: list[dict], progress_id: str = None):
+    summary = planning.summarize(results)
+    logger.info(f"run summary: {summary}")
+    _progress(progress_id).finish(**summary)
+    return summary
+
+
+@App.task(bind=True)
+def load_quotes(
+    self,
+    database_name: str = "finance",
+    period: str = "1d",
+    symbol_prefix: str = None,
+    chunk_size: int = load_historical_quotes.DEFAULT_CHUNK_SIZE,
+    shard_size: int = planning.DEFAULT_SHARD_SIZE,
+    run_id: str = None,
+):
+    """Load quotes in shards; passing the `run_id` of an interrupted run resumes it where it stopped."""
+    run_id = run_id or checkpoint.run_id(self.name, database_name, period, symbol_prefix, self.request.id)
+    app = load_historical_quotes.Quotes(database_name)
+    connection = app.clone(vaultdb_user, vaultdb_password)
+    tickers = _symbols(connection, symbol_prefix, columns="exchange, symbol, ipoyear")
+    costs = planning.quote_cost(tickers, period)
+    shards = planning.plan_shards(tickers["symbol"].tolist(), shard_size, costs=costs.tolist())
+    return _fan_out(
+        self, load_quotes_shard, shards, database_name, period=period, chunk_size=chunk_size, run_id=run_id
+    )
+
+
+@App.task(bind=True)
+def load_quotes_tier(
+    self,
+    tier: str,
+    database_name: str = "finance",
+    period: str = load_historical_quotes.INCREMENTAL,
+    chunk_size: int = load_historical_quotes.DEFAULT_CHUNK_SIZE,
+    shard_size: int = planning.DEFAULT_SHARD_SIZE,
+):
+    """Load quotes of the symbols in `tier`, with shards on the tier's queue and priority."""
+    tier = planning.get_tier(tier)
+    app = load_historical_quotes.Quotes(database_name)
+    connection = app.clone(vaultdb_user, vaultdb_password)
+    tickers = _symbols(connection, columns='exchange, symbol, ipoyear, "marketCap", volume')
+    tickers = tickers[planning.assign_tiers(tickers) == tier["name"]]
+    costs = planning.quote_cost(tickers, period)
+    shards = planning.plan_shards(tickers["symbol"].tolist(), shard_size, costs=costs.tolist())
+    # tiers run several times a day, a run only resumes its own redelivered shards
+    return _fan_out(
+        self,
+        load_quotes_shard,
+        shards,
+        database_name,
+        period=period,
+        chunk_size=chunk_size,
+        run_id=checkpoint.run_id(self.name, database_name, tier["name"], self.request.id),
+        options={"queue": tier["queue"], "priority": tier["priority"]},
+    )
+
+
+# acks_late redelivers a shard whose worker died, the checkpoint lets it skip what was done
+@App.task(acks_late=True, reject_on_worker_lost=True)
+def load_quotes_shard(
+    symbols: list[str],
+    database_name: str = "finance",
+    period: str = "1d",
+    chunk_size: int = load_historical_quotes.DEFAULT_CHUNK_SIZE,
+    progress_id: str = None,
+    run_id: str = None,
+):
+    app = load_historical_quotes.Quotes(database_name)
+    app.clone(vaultdb_user, vaultdb_password)
+    reporter = _progress(progress_id)
+    completed = _checkpoint(run_id)
+    pending = [symbol for symbol in symbols if not completed.is_done(symbol)]
+    reporter.advance(symbols=len(symbols) - len(pending))
+    failed = []
+    with app.buffered() as write_buffer:
+        on_chunk = _chunk_done(reporter, completed, write_buffer, failed)
+        if period == load_historical_quotes.INCREMENTAL:
+            rows = app.load_incremental(pending, chunk_size=chunk_size, on_chunk=on_chunk)
+        else:
+            rows = app.load_batch(pending, period=period, chunk_size=chunk_size, on_chunk=on_chunk)
+    completed.save(write_buffer)
+    # runs once the quotes are merged, over the trailing window they changed
+    with app.buffered():
+        indicator_rows = app.load_indicators(symbols, chunk_size=chunk_size)
+    sessions.evict()
+    return {
+        "symbols": len(symbols),
+        "rows": rows,
+        "failed": sorted(set(failed) | write_buffer.failed_owners()),
+        "indicators": indicator_rows,
+        "writes": write_buffer.stats(),
+    }
+
+
+@App.task(bind=True)
+def load_intraday(
+    self,
+    database_name: str = "finance",
+    interval: str = "5m",
+    symbol_prefix: str = None,
+    chunk_size: int = load_historical_quotes.DEFAULT_CHUNK_SIZE,
+    shard_size: int = planning.DEFAULT_SHARD_SIZE,
+):
+    """Stream intraday bars of every symbol into `quote_intraday`."""
+    # fail before fanning out when the interval is not an intraday one
+    load_historical_quotes.windows(interval)
+    app = load_historical_quotes.Quotes(database_name)
+    connection = app.clone(vaultdb_user, vaultdb_password)
+    tickers = _symbols(connection, symbol_prefix)
+    shards = planning.plan_shards(tickers["symbol"].tolist(), shard_size)
+    return _fan_out(
+        self,
+        load_intraday_shard,
+        shards,
+        database_name,
+        interval=interval,
+        chunk_size=chunk_size,
+        run_id=checkpoint.run_id(self.name, database_name, interval, self.request.id),
+    )
+
+
+@App.task(acks_late=True, reject_on_worker_lost=True)
+def load_intraday_shard(
+    symbols: list[str],
+    database_name: str = "finance",
+    interval: str = "5m",
+    chunk_size: int = load_historical_quotes.DEFAULT_CHUNK_SIZE,
+    progress_id: str = None,
+    run_id: str = None,
+):
+    app = load_historical_quotes.Quotes(database_name)
+    app.clone(vaultdb_user, vaultdb_password)
+    reporter = _progress(progress_id)
+    completed = _checkpoint(run_id)
+    pending = [symbol for symbol in symbols if not completed.is_done(symbol)]
+    reporter.advance(symbols=len(symbols) - len(pending))
+    memory_budget = load_historical_quotes.DEFAULT_STREAM_MEMORY
+    failed = []
+    with app.buffered(max_bytes=memory_budget // 2) as write_buffer:
+        rows = app.load_stream(
+            pending,
+            interval=interval,
+            chunk_size=chunk_size,
+            memory_budget=memory_budget,
+            on_chunk=_chunk_done(reporter, completed, write_buffer, failed),
+        )
+    completed.save(write_buffer)
+    sessions.evict()
+    return {
+        "symbols": len(symbols),
+        "rows": rows,
+        "failed": sorted(set(failed) | write_buffer.failed_owners()),
+        "writes": write_buffer.stats(),
+    }
+
+
+@App.task(bind=True)
+def load_instrument_details(
+    self, database_name: str = "finance", shard_size: int = planning.DEFAULT_SHARD_SIZE, run_id: str = None
+):
+    run_id = run_id or checkpoint.run_id(self.name, database_name, self.request.id)
     app = load_instrument.InstrumentFinancial(database_name)
     connection = app.clone(vaultdb_user, vaultdb_password)
-    connection.execute(f"PRAGMA enable_data_inheritance;;")
-    tickers = connection.execute(f"select exchange, symbol from tickers;").fetchdf()
-    for row in tickers.itertuples(index=False):
-        try:
-            app.load()
-        except Exception as ex:
-            logger.error(ex)
+    tickers = _symbols(connection)
+    shards = planning.plan_shards(tickers["symbol"].tolist(), shard_size)
+    return _fan_out(self, load_instrument_details_shard, shards, database_name, run_id=run_id)
+
+
+@App.task(acks_late=True, reject_on_worker_lost=True)
+def load_instrument_details_shard(
+    symbols: list[str], database_name: str = "finance", progress_id: str = None, run_id: str = None
+):
+    app = load_instrument.InstrumentFinancial(database_name)
+    app.clone(vaultdb_user, vaultdb_password)
+    reporter = _progress(progress_id)
+    # checkpointed per symbol and table, tables that failed are loaded again on resume
+    completed = _checkpoint(run_id)
+    failed = []
+    unchanged = 0
+    with app.buffered() as write_buffer:
+        rows = 0
+        for symbol in symbols:
+            try:
+                unchanged += app.load(symbol, checkpoint=completed)["unchanged"]
+                rows = _advance(reporter, write_buffer, rows)
+            except Exception as ex:
+                logger.error(ex)
+                failed.append(symbol)
+                rows = _advance(reporter, write_buffer, rows, errors=1)
+            completed.save(write_buffer, min_pending=CHECKPOINT_ITEMS)
+    completed.save(write_buffer)
+    # rows of the final flush and merges that failed after their symbol was loaded
+    rows = _advance(reporter, write_buffer, rows, symbols=0)
+    failed.extend(sorted(write_buffer.failed_owners() - set(failed)))
+    sessions.evict()
+    return {
+        "symbols": len(symbols),
+        "rows": rows,
+        "failed": failed,
+        "unchanged": unchanged,
+        "writes": write_buffer.stats(),
+    }
+
+
+@App.task(bind=True)
+def load_options_and_quotes(
+    self,
+    database_name: str = "finance",
+    period: str = None,
+    shard_size: int = planning.DEFAULT_SHARD_SIZE,
+    run_id: str = None,
+):
+    run_id = run_id or checkpoint.run_id(self.name, database_name, period, self.request.id)
+    app = load_instrument.InstrumentFinancial(database_name)
+    connection = app.clone(vaultdb_user, vaultdb_password)
+    tickers = _symbols(connection)
+    shards = planning.plan_shards(tickers["symbol"].tolist(), shard_size)
+    return _fan_out(self, load_options_and_quotes_shard, shards, database_name, period=period, run_id=run_id)
+
+
+@App.task(acks_late=True, reject_on_worker_lost=True)
+def load_options_and_quotes_shard(
+    symbols: list[str], database_name: str = "finance", period: str = None, progress_id: str = None, run_id: str = None
+):
+    app = load_instrument.InstrumentFinancial(database_name)
+    app.clone(vaultdb_user, vaultdb_password)
+    reporter = _progress(progress_id)
+    completed = _checkpoint(run_id)
+    pending = [symbol for symbol in symbols if not completed.is_done(symbol)]
+    reporter.advance(symbols=len(symbols) - len(pending))
+    failed = []
+    with app.buffered() as write_buffer:
+        rows = 0
+        for symbol in pending:
+            try:
+                app.symbol = symbol
+                # failed expiries are logged by the loader, the symbol is loaded again on resume
+                errors = app.load_options_and_quotes(period=period)
+                rows = _advance(reporter, write_buffer, rows, errors=1 if errors else 0)
+                if errors:
+                    failed.append(symbol)
+                else:
+                    completed.mark(symbol)
+            except Exception as ex:
+                logger.error(ex)
+                failed.append(symbol)
+                rows = _advance(reporter, write_buffer, rows, errors=1)
+            completed.save(write_buffer, min_pending=CHECKPOINT_ITEMS)
+    completed.save(write_buffer)
+    rows = _advance(reporter, write_buffer, rows, symbols=0)
+    failed.extend(sorted(write_buffer.failed_owners() - set(failed)))
+    with app.buffered():
+        contracts = app.load_option_analytics(symbols)
+    sessions.evict()
+    return {
+        "symbols": len(symbols),
+        "rows": rows,
+        "failed": failed,
+        "contracts": contracts,
+        "writes": write_buffer.stats(),
+    }
 
 
 @App.task()
-def load_options_and_quotes(database_name: str = "finance", period: str = "1d"):
+def load_option_analytics(database_name: str = "finance", symbol_prefix: str = None):
+    """Value every stored chain again, e.g. after the underlyings' quotes were refreshed."""
     app = load_instrument.InstrumentFinancial(database_name)
     connection = app.clone(vaultdb_user, vaultdb_password)
-    connection.execute(f"PRAGMA enable_data_inheritance;;")
-    tickers = connection.execute(f"select exchange, symbol from tickers;").fetchdf()
-    for row in tickers.itertuples(index=False):
-        try:
-            load_instrument.load_options_and_quotes(connection, row.symbol, period=period)
-        except Exception as ex:
-            logger.error(ex)
-
-"""
-from vaultdb.compute.schedules import crontab
-
-App.conf.beat_schedule = {
-    # Executes every Monday morning at 7:30 a.m.
-    "load_quotes_daily": {
-        "task": "tasks.load_quotes",
-        "schedule": crontab(hour=5, minute=30, day_of_week=1),
-        "args": ("finance", "1d"),
-    },
+    tickers = _symbols(connection, symbol_prefix)
+    with app.buffered() as write_buffer:
+        contracts = app.load_option_analytics(tickers["symbol"].tolist())
+    return {"contracts": contracts, "writes": write_buffer.stats()}
+
+
+@App.task()
+def export_parquet(database_name: str = "finance", root: str = parquet.EXPORT_ROOT, tables: list[str] = None):
+    """Rewrite the partitions that changed since the last export in the Parquet snapshot under `root`."""
+    app = parquet.ParquetExport(database_name)
+    app.clone(vaultdb_user, vaultdb_password)
+    with app.buffered():
+        exported = app.export(tables, root)
+    logger.info(f"exported to {root}: {exported}")
+    return exported
+
+
+def _beat_schedule() -> dict:
+    """One quotes refresh per tier, on the tier's schedule and queue, and a nightly Parquet export."""
+    schedule = {
+        f"load_quotes_{tier['name']}": {
+            "task": "tasks.load_quotes_tier",
+            "schedule": crontab(**tier["schedule"]),
+            "args": (tier["name"],),
+            "options": {"queue": tier["queue"], "priority": tier["priority"]},
+        }
+        for tier in planning.TIERS
+    }
+    schedule["export_parquet"] = {
+        "task": "tasks.export_parquet",
+        "schedule": crontab(minute=30, hour=7, day_of_week="tue-sat"),
+        "options": {"queue": "low"},
+    }
+    return schedule
+
+
+App.conf.beat_schedule = _beat_schedule()
+# redis ignores message priorities unless they are split into priority steps; workers consume their queues
+# in the order given with -Q and only prefetch one task, so a queued high priority shard is not stuck behind them
+App.conf.broker_transport_options = {
+    **(App.conf.broker_transport_options or {}),
+    "priority_steps": list(range(10)),
+    "sep": ":",
+    "queue_order_strategy": "priority",
 }
-"""
+App.conf.worker_prefetch_multiplier = 1
 
 if __name__ == "__main__":
     load_instrument_details()
     # load_quotes(period="max")
     # load_quotes(period="1d")
+    # load_quotes(period="incremental")
+    # load_quotes_tier("core")
     # load_options_and_quotes()
     # import sys
     # from celery.__main__ import main